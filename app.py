@@ -1,10 +1,7 @@
 import streamlit as st
 from raglab.config import Settings
-from raglab.embed import Embedder
-from raglab.index import FaissIndex
-from raglab.retrieve import Retriever
 from raglab.pipeline import ChatRAG
-from raglab.llm import LLM
+from raglab import metrics
 
 cfg = Settings.load("config/config.yaml")
 
@@ -13,31 +10,36 @@ st.title(cfg.ui["title"])
 
 # Quick guardrails
 banned = set(map(str.lower, cfg.ui.get("banned_queries", [])))
+debug = cfg.ui.get("debug", False)
 
-@st.cache_resource # Cache the retriever and LLM to avoid reloading
+@st.cache_resource(show_spinner=False) # Cache the retriever and LLM to avoid reloading
 def load_stack():
-    embedder = Embedder(cfg.embeddings["model_name"], cfg.embeddings["batch_size"])
-    ix = FaissIndex(cfg.index["faiss_path"], cfg.index["meta_path"])
-    ix.load()
-    retriever = Retriever(ix, embedder, cfg.retriever["top_k"], cfg.retriever["use_mmr"], cfg.retriever["mmr_lambda"])
-    llm = LLM(**cfg.llm)
-    rag = ChatRAG(retriever, llm, cfg.retriever["min_score"])
+    metrics.configure({**cfg.metrics, "enabled": cfg.metrics.get("enabled", False) or debug}) # the debug panel needs the timers
+    rag = ChatRAG.from_config(cfg) # serves the memory-mapped snapshot if ingest wrote one
+    if cfg.ui.get("warm_up", True): # load models and touch the indexes now, not on the first question
+        rag.warm_up()
     return rag
 
-rag = load_stack() # Load the RAG stack
+with st.spinner("Loading models and index..."): # the page is already drawn, only the first session waits here
+    rag = load_stack() # Load the RAG stack
 
 if "history" not in st.session_state:
     st.session_state.history = [] # Initialize chat history
 
-q = st.chat_input("Ask a question...") # Chat input box
+# List the sources of an answer
+def show_sources(sources):
+    if sources: # if there are sources
+        st.caption("Sources:") # caption
+        for i, u in enumerate(sources, 1):
+            st.write(f"[{i}] {u}") # list sources
 
-if q:
-    if any(word in q.lower() for word in banned):
-        st.warning("Your query contains banned words. Please modify and try again.")
-    else:
-        st.session_state.history.append(("user", q)) # Add user message to history
-        out = rag.answer(q) # Get answer from RAG
-        st.session_state.history.append(("assistant", out["answer"], out["sources"])) # Add assistant message to history
+# Debug panel: where the time of one answer went
+def show_trace(tr):
+    if tr: # only recorded with ui.debug
+        with st.expander(f"Debug: {tr['total_ms']:.0f} ms"):
+            st.table([{"stage": s["name"], "ms": round(s["ms"], 1)} for s in tr["spans"]])
+            if tr["values"]:
+                st.json(tr["values"]) # prompt tokens, candidates, cache hits, ...
 
 for turn in st.session_state.history: # Display chat history
     role = turn[0] # role: user or assistant
@@ -47,8 +49,24 @@ for turn in st.session_state.history: # Display chat history
     else:
         with st.chat_message("assistant"):
             st.markdown(turn[1]) # assistant message
-            sources = turn[2] # sources
-            if sources: # if there are sources
-                st.caption("Sources:") # caption
-                for i, u in enumerate(sources, 1):
-                    st.write(f"[{i}] {u}") # list sources
\ No newline at end of file
+            show_sources(turn[2]) # sources
+            show_trace(turn[3] if len(turn) > 3 else None) # timing breakdown
+
+q = st.chat_input("Ask a question...") # Chat input box
+
+if q:
+    if any(word in q.lower() for word in banned):
+        st.warning("Your query contains banned words. Please modify and try again.")
+    else:
+        with st.chat_message("user"):
+            st.write(q) # user message
+        with st.chat_message("assistant"), metrics.trace("answer") as tr:
+            stream = rag.answer_stream(q) # sources first, then answer tokens
+            sources = next(stream)
+            answer = st.write_stream(stream) # render tokens as they arrive
+            show_sources(sources)
+            trace = tr.to_dict() if tr is not None and debug else None
+            show_trace(trace)
+        metrics.export()
+        st.session_state.history.append(("user", q)) # Add user message to history
+        st.session_state.history.append(("assistant", answer, sources, trace)) # Add assistant message to history
@@ -0,0 +1,65 @@
+# Benchmark FAISS index types on a synthetic corpus: recall@k vs flat, query latency and index size
+#
+#   python bench/bench_ann.py --n 1000000 --dim 384 --types flat hnsw ivf_flat ivf_pq
+
+import sys, time, argparse, tempfile, os
+from pathlib import Path
+import numpy as np
+import faiss
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1])) # run from anywhere
+from raglab.index import create_index, INDEX_TYPES, DEFAULT_PARAMS
+
+# Clustered unit vectors, closer to real embeddings than uniform noise
+def synthetic(n: int, dim: int, clusters: int, seed: int = 0, block: int = 100_000) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    X = np.empty((n, dim), dtype=np.float32)
+    for s in range(0, n, block): # generate in blocks to bound temporary memory
+        e = min(n, s + block)
+        X[s:e] = centers[rng.integers(0, clusters, e - s)] + 0.5 * rng.standard_normal((e - s, dim)).astype(np.float32)
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    return X
+
+def index_bytes(index: faiss.Index) -> int:
+    with tempfile.TemporaryDirectory() as d: # write to disk instead of serialize_index to avoid a second in-memory copy
+        path = os.path.join(d, "bench.index")
+        faiss.write_index(index, path)
+        return os.path.getsize(path)
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--n", type=int, default=1_000_000)
+ap.add_argument("--dim", type=int, default=384)
+ap.add_argument("--queries", type=int, default=1000)
+ap.add_argument("--k", type=int, default=5)
+ap.add_argument("--clusters", type=int, default=2000)
+ap.add_argument("--types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES)
+for name, value in DEFAULT_PARAMS.items():
+    ap.add_argument(f"--{name}", type=int, default=value)
+args = ap.parse_args()
+params = {name: getattr(args, name) for name in DEFAULT_PARAMS}
+
+print(f"Generating {args.n:,} x {args.dim} vectors...")
+X = synthetic(args.n, args.dim, args.clusters)
+rng = np.random.default_rng(1)
+Q = X[rng.integers(0, args.n, args.queries)] + 0.1 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+Q /= np.linalg.norm(Q, axis=1, keepdims=True)
+
+print("Exact ground truth (flat)...")
+_, truth = create_index(X, "flat").search(Q, args.k)
+
+print(f"\n{'type':>9} {'build s':>9} {f'recall@{args.k}':>10} {'p50 ms':>8} {'p99 ms':>8} {'MB':>9}")
+for kind in args.types:
+    t0 = time.perf_counter()
+    index = create_index(X, kind, params)
+    build_s = time.perf_counter() - t0
+    lat, hits = [], 0
+    for i in range(args.queries): # one query at a time, like the serving path
+        t0 = time.perf_counter()
+        _, I = index.search(Q[i:i+1], args.k)
+        lat.append(time.perf_counter() - t0)
+        hits += len(set(I[0]) & set(truth[i]))
+    lat = np.array(lat) * 1e3
+    size_mb = index_bytes(index) / 2**20
+    print(f"{kind:>9} {build_s:>9.1f} {hits/(args.queries*args.k):>10.3f} {np.percentile(lat, 50):>8.3f} {np.percentile(lat, 99):>8.3f} {size_mb:>9.1f}")
+    del index
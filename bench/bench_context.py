@@ -0,0 +1,55 @@
+# Context packing on eval/qas.jsonl: prompt tokens, render time and whether the gold answer is still in the prompt
+# (eval.match_gold on the context), for the raw concatenation of retrieved chunks vs the packed context at several budgets.
+# Prompt tokens drive prefill time, i.e. time to first token. Needs a built index: python ingest.py --config config/config.yaml
+#
+#   python bench/bench_context.py --config config/config.yaml --budgets 1024 2048 3072
+
+import sys, json, time, argparse
+from pathlib import Path
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT)) # run from anywhere
+from raglab.config import Settings
+from raglab.chunk import TokenSizer, encoding_for
+from raglab.embed import CachedEmbedder
+from raglab.index import serving_config
+from raglab.shards import open_index
+from raglab.retrieve import Retriever
+from raglab.prompt import PREFIX, TEMPLATE, render_prompt
+from eval import match_gold
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--config", default="config/config.yaml")
+ap.add_argument("--budgets", type=int, nargs="+", default=[1024, 2048, 3072], help="context token budgets to try")
+args = ap.parse_args()
+
+cfg = Settings.load(args.config)
+qas = [json.loads(l) for l in open(ROOT / "eval" / "qas.jsonl", encoding="utf-8")]
+index_cfg = serving_config(cfg.index)
+ix = open_index(index_cfg)
+retriever = Retriever.from_config(cfg.retriever, ix, CachedEmbedder.from_config(cfg.embeddings), index_cfg.get("lexical_path"))
+hits = retriever.retrieve_batch([qa["q"] for qa in qas])
+sizer = TokenSizer(encoding_for(cfg.llm["model"]))
+
+# Before packing: every retrieved chunk verbatim, numbered by rank
+def render_raw(question, docs):
+    context = "\n\n".join(f"[{i}] {d['text']}" for i, d in enumerate(docs, 1))
+    return PREFIX + TEMPLATE.format(context=context, question=question), [d["url"] for d in docs]
+
+setups = {"raw": render_raw, "packed": lambda q, docs: render_prompt(q, docs, None, sizer)}
+for b in args.budgets:
+    setups[f"packed {b}"] = lambda q, docs, b=b: render_prompt(q, docs, b, sizer)
+
+print(f"{len(qas)} questions, top_k={retriever.top_k}, encoding {sizer.enc.name}, system prefix {sizer.count(PREFIX)} tokens")
+print(f"{'context':>14} {'tokens':>7} {'max':>6} {'sources':>8} {'render ms':>10} {'gold in ctx':>12}")
+for name, render in setups.items():
+    tokens, sources, ms, gold = [], [], [], 0
+    for qa, (docs, _) in zip(qas, hits):
+        t0 = time.perf_counter()
+        prompt, urls = render(qa["q"], docs)
+        ms.append((time.perf_counter() - t0) * 1000)
+        tokens.append(sizer.count(prompt))
+        sources.append(len(urls))
+        gold += match_gold(prompt.split("<context>", 1)[1].split("</context>", 1)[0], qa["a"])
+    print(f"{name:>14} {np.mean(tokens):>7.0f} {max(tokens):>6} {np.mean(sources):>8.2f} {np.mean(ms):>10.2f} {gold / len(qas):>12.3f}")
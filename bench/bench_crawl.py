@@ -0,0 +1,71 @@
+# Crawl throughput against a local stand-in site (http.server with simulated, jittered latency). With --max-pages below
+# the site size, every run must still crawl the same pages in the same order as the first one (concurrency 1 by default).
+#
+#   python bench/bench_crawl.py --pages 300 --max-pages 60 --latency-ms 50 --concurrency 1 4 8 16
+
+import sys, time, random, argparse, tempfile, threading, logging
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1])) # run from anywhere
+from raglab.scrape import crawl
+
+WORDS = "python asyncio gather functools lru_cache pathlib json venv typing dataclass logging shutil regex argparse".split()
+
+# Deterministic site: page i links to `links` random pages, each page has a few paragraphs of text
+def make_site(n: int, links: int = 10, seed: int = 0) -> dict[str, bytes]:
+    rng = random.Random(seed)
+    pages = {}
+    for i in range(n):
+        paras = "".join("<p>" + " ".join(rng.choice(WORDS) for _ in range(120)) + "</p>" for _ in range(8))
+        hrefs = "".join(f'<li><a href="/p{j}.html">page {j}</a></li>' for j in rng.sample(range(n), min(links, n)))
+        pages[f"/p{i}.html"] = (f"<html><head><title>Page {i}</title></head><body><nav><ul>{hrefs}</ul></nav>"
+                                f"<article><h1>Page {i}</h1>{paras}</article></body></html>").encode()
+    return pages
+
+# Serve the site on localhost in a background thread; each response waits `latency` (+ up to `jitter`) seconds like a remote server
+def serve(pages: dict[str, bytes], latency: float, jitter: float = 0.0) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # keep-alive, so pooled sessions can reuse connections
+        def do_GET(self):
+            time.sleep(latency + random.uniform(0, jitter)) # responses finish out of request order
+            body = pages.get(self.path.split("#")[0])
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args): pass
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pages", type=int, default=200)
+    ap.add_argument("--max-pages", type=int, default=None, help="crawl limit (default: the whole site)")
+    ap.add_argument("--latency-ms", type=float, default=50)
+    ap.add_argument("--jitter-ms", type=float, default=50)
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16])
+    ap.add_argument("--per-host-rps", type=float, default=0)
+    args = ap.parse_args()
+    logging.getLogger("trafilatura").setLevel(logging.ERROR)
+
+    server = serve(make_site(args.pages), args.latency_ms / 1000, args.jitter_ms / 1000)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    max_pages = args.max_pages or args.pages
+    reference = None
+    print(f"{'concurrency':>11} {'pages':>6} {'seconds':>8} {'pages/s':>8} {'same pages':>11} {'same order':>11}")
+    for c in args.concurrency:
+        with tempfile.TemporaryDirectory() as out:
+            t0 = time.perf_counter()
+            docs = list(crawl([f"{base}/p0.html"], "127.0.0.1", Path(out), max_pages=max_pages, concurrency=c, per_host_rps=args.per_host_rps))
+            dt = time.perf_counter() - t0
+        urls = [d["url"] for d in docs]
+        reference = reference or urls # first run is the reference
+        print(f"{c:>11} {len(docs):>6} {dt:>8.2f} {len(docs)/dt:>8.1f} {str(set(urls) == set(reference)):>11} {str(urls == reference):>11}")
+    server.shutdown()
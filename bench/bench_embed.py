@@ -0,0 +1,45 @@
+# Ingest embedding stage (raglab.bulk_embed): chunks per second with and without length bucketing, in the ingest
+# process and with 1/2/4 worker processes. Every run starts cold (no embedding cache, no checkpoint), so worker times
+# include loading the model in each process, like a real ingest. Texts from data/processed/chunks.jsonl (run ingest.py first).
+#
+#   python bench/bench_embed.py --config config/config.yaml --chunks 4000 --workers 0 1 2 4
+
+import sys, json, time, argparse, tempfile
+from pathlib import Path
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT)) # run from anywhere
+from raglab.config import Settings
+from raglab.bulk_embed import BulkEmbedder
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--config", default="config/config.yaml")
+ap.add_argument("--chunks", type=int, default=4000)
+ap.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4], help="0 = in the calling process")
+ap.add_argument("--shard-size", type=int, default=None, help="default: embeddings.shard_size")
+args = ap.parse_args()
+
+cfg = Settings.load(args.config)
+emb_cfg = {**cfg.embeddings, "cache_size": 0, "cache_path": None} # every text reaches the model
+shard_size = args.shard_size or emb_cfg.get("shard_size", 1024)
+with open(ROOT / "data" / "processed" / "chunks.jsonl", encoding="utf-8") as f:
+    texts = [json.loads(line)["text"] for _, line in zip(range(args.chunks), f)]
+lengths = np.array([len(t) for t in texts])
+print(f"{len(texts)} chunks ({lengths.min()}-{lengths.max()} chars, median {np.median(lengths):.0f}), "
+      f"{emb_cfg.get('backend', 'torch')} backend, batch {emb_cfg['batch_size']}, shards of {shard_size}")
+
+print(f"{'workers':>7} {'bucketed':>9} {'seconds':>8} {'chunks/s':>9} {'speedup':>8}")
+base, ref = None, None
+for workers in args.workers:
+    for bucket in (False, True):
+        with tempfile.TemporaryDirectory() as work_dir:
+            stage = BulkEmbedder(emb_cfg, work_dir, shard_size, workers, bucket)
+            t0 = time.perf_counter()
+            X = np.array(stage.run(texts))
+            dt = time.perf_counter() - t0
+        if ref is None:
+            ref = X
+        assert np.allclose(X, ref, atol=1e-4), "vectors differ between setups"
+        base = base or dt
+        print(f"{workers:>7} {str(bucket):>9} {dt:>8.2f} {len(texts) / dt:>9.1f} {base / dt:>7.2f}x")
@@ -0,0 +1,50 @@
+# Dense vs BM25 vs hybrid (RRF) vs lexical fast path on eval/qas.jsonl: per-query latency and hit rate
+# (a question is a hit when the retrieved chunk texts contain its gold answer, as judged by eval.match_gold).
+# Needs a built index: python ingest.py --config config/config.yaml
+#
+#   python bench/bench_lexical.py --config config/config.yaml --margins 0.3 0.5
+
+import sys, json, time, argparse
+from pathlib import Path
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT)) # run from anywhere
+from raglab.config import Settings
+from raglab.embed import Embedder
+from raglab.index import FaissIndex
+from raglab.lexical import LexicalIndex
+from raglab.retrieve import Retriever
+from eval import match_gold
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--config", default="config/config.yaml")
+ap.add_argument("--margins", type=float, nargs="+", default=[0.3, 0.5], help="lexical fast path margins to try")
+args = ap.parse_args()
+
+cfg = Settings.load(args.config)
+qas = [json.loads(l) for l in open(ROOT / "eval" / "qas.jsonl", encoding="utf-8")]
+embedder = Embedder(cfg.embeddings["model_name"], cfg.embeddings["batch_size"]) # no cache: every dense query pays for its encode
+embedder.encode(["warm-up"]) # load the model outside the timed region
+ix = FaissIndex.from_config(cfg.index)
+ix.load()
+lexical = LexicalIndex.load(cfg.index["lexical_path"])
+top_k, use_mmr, lam = cfg.retriever["top_k"], cfg.retriever["use_mmr"], cfg.retriever["mmr_lambda"]
+
+setups = {"dense": Retriever(ix, embedder, top_k, use_mmr, lam),
+          "bm25": Retriever(ix, embedder, top_k, use_mmr, lam, lexical, fast_path_margin=0.0), # margin 0: every query with a term match
+          "hybrid": Retriever(ix, embedder, top_k, use_mmr, lam, lexical, "hybrid", cfg.retriever.get("rrf_k", 60))}
+for m in args.margins:
+    setups[f"hybrid+fast {m}"] = Retriever(ix, embedder, top_k, use_mmr, lam, lexical, "hybrid", cfg.retriever.get("rrf_k", 60), m)
+
+print(f"{'retriever':>16} {'hit rate':>9} {'mean ms':>8} {'p95 ms':>8} {'encoded':>8}")
+for name, retriever in setups.items():
+    lat, hits, encoded = [], 0, 0
+    for qa in qas:
+        timings = {}
+        t0 = time.perf_counter()
+        docs, _ = retriever.retrieve_batch([qa["q"]], timings=timings)[0]
+        lat.append((time.perf_counter() - t0) * 1000)
+        encoded += timings["embed"] > 0
+        hits += match_gold("\n".join(d["text"] for d in docs), qa["a"])
+    print(f"{name:>16} {hits / len(qas):>8.1%} {np.mean(lat):>8.2f} {np.percentile(lat, 95):>8.2f} {encoded:>5}/{len(qas)}")
@@ -0,0 +1,37 @@
+# LLM client throughput: sequential generate vs generate_many / agenerate_many against the mock Ollama server,
+# with every k-th request failing (503) to check that retries recover them
+#
+#   python bench/bench_llm.py --prompts 32 --concurrency 8 --fail-every 5
+
+import os, sys, time, asyncio, argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1])) # run from anywhere
+from raglab.llm import LLM
+from mock_ollama import serve_mock_ollama
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--prompts", type=int, default=32)
+ap.add_argument("--concurrency", type=int, default=8)
+ap.add_argument("--tokens", type=int, default=64)
+ap.add_argument("--token-ms", type=float, default=5)
+ap.add_argument("--max-tokens", type=int, default=32)
+ap.add_argument("--fail-every", type=int, default=5)
+args = ap.parse_args()
+
+server = serve_mock_ollama(0, args.tokens, args.token_ms / 1000, fail_every=args.fail_every)
+os.environ["OLLAMA_HOST"] = f"http://127.0.0.1:{server.server_address[1]}"
+llm = LLM("ollama", "mock", max_tokens=args.max_tokens, max_concurrency=args.concurrency, max_retries=5, retry_backoff_sec=0.05)
+prompts = [f"question {i}" for i in range(args.prompts)]
+
+def report(name, fn):
+    t0 = time.perf_counter()
+    answers = fn()
+    dt = time.perf_counter() - t0
+    capped = all(len(a.split()) == min(args.tokens, args.max_tokens) for a in answers)
+    print(f"{name:<16} {dt*1e3:8.1f} ms  {len(answers)/dt:7.1f} answers/s | all {len(answers)} answered, max_tokens respected: {capped}")
+
+report("sequential", lambda: [llm.generate(p) for p in prompts])
+report("generate_many", lambda: llm.generate_many(prompts))
+report("agenerate_many", lambda: asyncio.run(llm.agenerate_many(prompts)))
+server.shutdown()
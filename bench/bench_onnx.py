@@ -0,0 +1,55 @@
+# Embedding backends on CPU: torch SentenceTransformer vs ONNX Runtime (fp32 and dynamic int8).
+# Throughput on chunk texts, and agreement with torch: recall@5 overlap of exact top-5 search over the same chunks
+# for the eval questions, both with every vector from the backend and with backend queries against torch documents
+# (an index built with torch, queried with ONNX). Needs: pip install onnxruntime optimum[onnxruntime]
+#
+#   python bench/bench_onnx.py --chunks 2000 --threads 4
+
+import sys, json, time, argparse
+from pathlib import Path
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT)) # run from anywhere
+from raglab.embed import Embedder, OnnxEmbedder
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--model", default="intfloat/e5-small-v2")
+ap.add_argument("--chunks", type=int, default=2000, help="texts from data/processed/chunks.jsonl (run ingest.py first)")
+ap.add_argument("--batch-size", type=int, default=64)
+ap.add_argument("--threads", type=int, default=0, help="ONNX Runtime intra-op threads (0 = all cores)")
+ap.add_argument("--onnx-dir", default="index/onnx")
+ap.add_argument("--k", type=int, default=5)
+args = ap.parse_args()
+
+chunks_path = ROOT / "data" / "processed" / "chunks.jsonl"
+with open(chunks_path, encoding="utf-8") as f:
+    texts = [json.loads(line)["text"] for _, line in zip(range(args.chunks), f)]
+questions = [json.loads(l)["q"] for l in open(ROOT / "eval" / "qas.jsonl", encoding="utf-8")]
+
+def top_k(q, docs):
+    return np.argsort(-(q @ docs.T), axis=1, kind="stable")[:, :args.k]
+
+def overlap(a, b):
+    return np.mean([len(set(x) & set(y)) / args.k for x, y in zip(a, b)])
+
+backends = {"torch": Embedder(args.model, args.batch_size),
+            "onnx fp32": OnnxEmbedder(args.model, args.batch_size, args.onnx_dir, quantize=False, threads=args.threads),
+            "onnx int8": OnnxEmbedder(args.model, args.batch_size, args.onnx_dir, quantize=True, threads=args.threads)}
+
+print(f"{len(texts)} chunks, {len(questions)} questions")
+print(f"{'backend':>10} {'texts/s':>9} {'speedup':>8} {'cos vs torch':>13} {'recall@%d' % args.k:>10} {'vs torch docs':>14}")
+ref = None
+for name, emb in backends.items():
+    emb.warm_up() # export/load outside the timed region
+    t0 = time.perf_counter()
+    docs = emb.encode(texts)
+    rate = len(texts) / (time.perf_counter() - t0)
+    queries = emb.encode(questions)
+    if ref is None: # torch: the reference
+        ref = {"rate": rate, "docs": docs, "top": top_k(queries, docs)}
+        print(f"{name:>10} {rate:>9.1f} {1.0:>7.2f}x {'-':>13} {'-':>10} {'-':>14}")
+        continue
+    cos = float(np.mean(np.sum(docs * ref["docs"], axis=1)))
+    print(f"{name:>10} {rate:>9.1f} {rate / ref['rate']:>7.2f}x {cos:>13.4f} {overlap(top_k(queries, docs), ref['top']):>10.3f} "
+          f"{overlap(top_k(queries, ref['docs']), ref['top']):>14.3f}")
@@ -0,0 +1,51 @@
+# Retrieval throughput: Retriever.retrieve per query vs Retriever.retrieve_batch at several batch sizes
+#
+#   python bench/bench_retrieve.py --model intfloat/e5-small-v2 --chunks 20000 --batch-sizes 1 8 64
+
+import sys, json, time, argparse, tempfile
+from pathlib import Path
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT)) # run from anywhere
+from raglab.embed import Embedder
+from raglab.index import FaissIndex
+from raglab.retrieve import Retriever
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--model", default="intfloat/e5-small-v2")
+ap.add_argument("--chunks", type=int, default=20000, help="synthetic corpus size")
+ap.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 64])
+ap.add_argument("--queries", type=int, default=256)
+ap.add_argument("--top-k", type=int, default=5)
+ap.add_argument("--no-mmr", action="store_true")
+args = ap.parse_args()
+
+embedder = Embedder(args.model, batch_size=64) # no cache: every query pays for its encode
+questions = [json.loads(l)["q"] for l in open(ROOT / "eval" / "qas.jsonl", encoding="utf-8")]
+questions = [questions[i % len(questions)] + f" ({i})" for i in range(args.queries)] # distinct texts
+dim = embedder.encode(["warm-up"]).shape[1] # loads the model outside the timed region
+
+with tempfile.TemporaryDirectory() as d: # synthetic corpus: random unit vectors with the model's dimension
+    X = np.random.default_rng(0).standard_normal((args.chunks, dim)).astype("float32")
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    ix = FaissIndex(f"{d}/faiss.index", f"{d}/meta.bin")
+    ix.build(X, [{"url": f"https://example.org/{i // 10}", "title": "", "text": f"chunk {i}"} for i in range(args.chunks)])
+    ix.save()
+    ix = FaissIndex(f"{d}/faiss.index", f"{d}/meta.bin")
+    ix.load()
+    retriever = Retriever(ix, embedder, args.top_k, not args.no_mmr)
+
+    t0 = time.perf_counter()
+    single = [retriever.retrieve(q) for q in questions]
+    base_qps = len(questions) / (time.perf_counter() - t0)
+    print(f"{'mode':>14} {'queries/s':>10} {'speedup':>8} {'same results':>13}")
+    print(f"{'loop':>14} {base_qps:>10.1f} {1.0:>7.1f}x {'-':>13}")
+    for bs in args.batch_sizes:
+        t0 = time.perf_counter()
+        batched = []
+        for s in range(0, len(questions), bs):
+            batched += retriever.retrieve_batch(questions[s:s + bs])
+        qps = len(questions) / (time.perf_counter() - t0)
+        same = all([x["id"] for x in a[0]] == [x["id"] for x in b[0]] for a, b in zip(single, batched))
+        print(f"{f'batch={bs}':>14} {qps:>10.1f} {qps/base_qps:>7.1f}x {str(same):>13}")
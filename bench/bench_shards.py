@@ -0,0 +1,66 @@
+# Sharded dense search (raglab.shards) on a synthetic corpus: single-query latency and batched throughput against
+# the number of shards, next to the unsharded index searched in-process. Every search asks for the retriever's MMR
+# candidate pool (top_k * 4 with their vectors), and results are checked against the unsharded index.
+#
+#   python bench/bench_shards.py --chunks 500000 --dim 384 --shards 1 2 4 8 --type flat
+
+import sys, time, argparse, tempfile
+from pathlib import Path
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT)) # run from anywhere
+from raglab.index import FaissIndex
+from raglab.shards import ShardedIndex, write_shards
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--chunks", type=int, default=200000, help="synthetic corpus size")
+ap.add_argument("--dim", type=int, default=384)
+ap.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+ap.add_argument("--type", default="flat", help="flat | hnsw | ivf_flat | ivf_pq")
+ap.add_argument("--queries", type=int, default=200)
+ap.add_argument("--batch-size", type=int, default=32)
+ap.add_argument("--candidates", type=int, default=20, help="results per query (retriever: top_k * 4)")
+args = ap.parse_args()
+
+rng = np.random.default_rng(0)
+X = rng.standard_normal((args.chunks, args.dim)).astype("float32")
+X /= np.linalg.norm(X, axis=1, keepdims=True)
+Q = X[rng.choice(args.chunks, args.queries, replace=False)] + 0.1 * rng.standard_normal((args.queries, args.dim)).astype("float32")
+Q /= np.linalg.norm(Q, axis=1, keepdims=True)
+
+def measure(ix) -> dict:
+    ix.search_batch(Q[:1], args.candidates, return_vectors=True) # first touch of memory-mapped pages
+    lat = []
+    for q in Q:
+        t0 = time.perf_counter()
+        ix.search(q, args.candidates, return_vectors=True)
+        lat.append((time.perf_counter() - t0) * 1000)
+    t0 = time.perf_counter()
+    hits = []
+    for s in range(0, len(Q), args.batch_size):
+        hits += ix.search_batch(Q[s:s + args.batch_size], args.candidates, return_vectors=True)
+    qps = len(Q) / (time.perf_counter() - t0)
+    return {"p50": np.percentile(lat, 50), "p95": np.percentile(lat, 95), "qps": qps, "ids": [[d["id"] for d in h[1]] for h in hits]}
+
+with tempfile.TemporaryDirectory() as d:
+    meta = [{"url": f"https://example.org/{i // 10}", "title": "", "text": f"chunk {i}"} for i in range(args.chunks)]
+    ix = FaissIndex(f"{d}/faiss.index", f"{d}/meta.bin", index_type=args.type)
+    t0 = time.perf_counter()
+    ix.build(X, meta)
+    ix.save()
+    print(f"{args.chunks} x {args.dim} {args.type}, built in {time.perf_counter() - t0:.1f}s; {args.queries} queries, "
+          f"{args.candidates} candidates with vectors, batches of {args.batch_size}")
+    ix = FaissIndex(f"{d}/faiss.index", f"{d}/meta.bin", mmap=True)
+    ix.load()
+    base = measure(ix)
+    print(f"{'setup':>12} {'p50 ms':>8} {'p95 ms':>8} {'batch q/s':>10} {'speedup':>8} {'recall vs 1':>12}")
+    print(f"{'unsharded':>12} {base['p50']:>8.2f} {base['p95']:>8.2f} {base['qps']:>10.1f} {1.0:>7.2f}x {'-':>12}")
+    for n in args.shards:
+        write_shards(ix, f"{d}/shards", n)
+        sharded = ShardedIndex(f"{d}/shards")
+        sharded.load()
+        r = measure(sharded)
+        sharded.close()
+        recall = np.mean([len(set(a) & set(b)) / max(1, len(a)) for a, b in zip(base["ids"], r["ids"])])
+        print(f"{f'{n} shards':>12} {r['p50']:>8.2f} {r['p95']:>8.2f} {r['qps']:>10.1f} {r['qps'] / base['qps']:>7.2f}x {recall:>12.3f}")
@@ -0,0 +1,56 @@
+# Cold start of the serving stack, each run in a fresh interpreter: import time, time to ready (stack built, optionally
+# warmed up) and latency of the first retrieval and first answer. The LLM is the mock Ollama server, so generation
+# time stays small and constant. Needs a built index; for the snapshot rows run `python ingest.py --snapshot` first.
+#
+#   python bench/bench_startup.py --config config/config.yaml --runs 3
+
+import os, sys, json, time, argparse, subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT)) # run from anywhere
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--config", default="config/config.yaml")
+ap.add_argument("--runs", type=int, default=3)
+ap.add_argument("--child", choices=["files", "snapshot"], help=argparse.SUPPRESS) # one measurement, in a fresh process
+ap.add_argument("--warm-up", action="store_true", help=argparse.SUPPRESS)
+args = ap.parse_args()
+
+if args.child: # measured process: prints one JSON line
+    t0 = time.perf_counter()
+    from raglab.config import Settings
+    from raglab.pipeline import ChatRAG
+    t1 = time.perf_counter()
+    cfg = Settings.load(args.config)
+    cfg.llm = {**cfg.llm, "provider": "ollama"} # the mock
+    cfg.answer_cache = {} # every run must really answer
+    if args.child == "files":
+        cfg.index = {**cfg.index, "snapshot_dir": None}
+    rag = ChatRAG.from_config(cfg)
+    if args.warm_up:
+        rag.warm_up()
+    t2 = time.perf_counter()
+    rag.retriever.retrieve("How do I create a virtual environment?")
+    t3 = time.perf_counter()
+    rag.answer("Which module parses JSON?")
+    t4 = time.perf_counter()
+    print(json.dumps({"import": t1 - t0, "ready": t2 - t1, "retrieve": t3 - t2, "answer": t4 - t3, "openai_imported": "openai" in sys.modules}))
+    sys.exit()
+
+from mock_ollama import serve_mock_ollama
+import numpy as np
+
+server = serve_mock_ollama(0, tokens=16, token_s=0.001)
+env = {**os.environ, "OLLAMA_HOST": f"http://127.0.0.1:{server.server_address[1]}"}
+print(f"{'setup':>20} {'import s':>9} {'ready s':>8} {'1st retrieve ms':>16} {'1st answer ms':>14} {'openai':>7}")
+for mode, warm in [("files", False), ("files", True), ("snapshot", True)]:
+    rows = []
+    for _ in range(args.runs):
+        cmd = [sys.executable, __file__, "--config", args.config, "--child", mode] + (["--warm-up"] if warm else [])
+        out = subprocess.run(cmd, env=env, cwd=os.getcwd(), capture_output=True, text=True, check=True).stdout
+        rows.append(json.loads(out.strip().splitlines()[-1]))
+    med = {k: float(np.median([r[k] for r in rows])) for k in ("import", "ready", "retrieve", "answer")}
+    name = f"{mode}{' + warm-up' if warm else ''}"
+    print(f"{name:>20} {med['import']:>9.2f} {med['ready']:>8.2f} {med['retrieve']*1e3:>16.1f} {med['answer']*1e3:>14.1f} {str(rows[0]['openai_imported']):>7}")
+server.shutdown()
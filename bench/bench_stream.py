@@ -0,0 +1,35 @@
+# Time-to-first-token: blocking LLM.generate vs LLM.generate_stream against the mock Ollama server
+#
+#   python bench/bench_stream.py --tokens 256 --token-ms 20
+
+import os, sys, time, argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1])) # run from anywhere
+from raglab.llm import LLM
+from mock_ollama import serve_mock_ollama
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--tokens", type=int, default=256)
+ap.add_argument("--token-ms", type=float, default=20)
+ap.add_argument("--prefill-ms", type=float, default=200)
+ap.add_argument("--runs", type=int, default=3)
+args = ap.parse_args()
+
+server = serve_mock_ollama(0, args.tokens, args.token_ms / 1000, args.prefill_ms / 1000)
+os.environ["OLLAMA_HOST"] = f"http://127.0.0.1:{server.server_address[1]}"
+llm = LLM("ollama", "mock")
+
+for run in range(args.runs):
+    t0 = time.perf_counter()
+    blocking = llm.generate("question")
+    t_block = time.perf_counter() - t0
+
+    t0, first, parts = time.perf_counter(), None, []
+    for piece in llm.generate_stream("question"):
+        first = first or time.perf_counter() - t0
+        parts.append(piece)
+    t_stream = time.perf_counter() - t0
+    same = "".join(parts) == blocking
+    print(f"run {run}: blocking first token {t_block*1e3:8.1f} ms | streaming first token {first*1e3:8.1f} ms, total {t_stream*1e3:8.1f} ms | same text: {same}")
+server.shutdown()
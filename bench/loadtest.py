@@ -0,0 +1,116 @@
+# Load test of the HTTP API (serve.py): replays the eval/qas.jsonl questions at a fixed rate against a server whose
+# LLM is the mock Ollama, once per micro-batching setting, and reports achieved throughput and latency percentiles.
+# Open loop: requests go out on schedule whatever the server's state, and latency counts from the scheduled send
+# time, so queueing shows up in the tail. Answer and embedding caches are off, every request does the full work.
+# Needs a built index: python ingest.py --config config/config.yaml
+#
+#   python bench/loadtest.py --config config/config.yaml --qps 20 50 100 --duration 20 --max-batch 1 32
+
+import os, sys, json, time, socket, argparse, tempfile, threading, subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import requests
+import yaml
+
+ROOT = Path(__file__).resolve().parents[1]
+from mock_ollama import serve_mock_ollama
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--config", default="config/config.yaml")
+ap.add_argument("--qps", type=float, nargs="+", default=[20, 50, 100], help="target request rates")
+ap.add_argument("--duration", type=float, default=20, help="seconds per rate")
+ap.add_argument("--max-batch", type=int, nargs="+", default=[1, 32], help="serve.max_batch settings to compare (1 = no batching)")
+ap.add_argument("--max-wait-ms", type=float, default=5)
+ap.add_argument("--llm-concurrency", type=int, default=64, help="llm.max_concurrency of the server")
+ap.add_argument("--tokens", type=int, default=32, help="mock answer length")
+ap.add_argument("--token-ms", type=float, default=2)
+ap.add_argument("--stream", action="store_true", help="use /answer/stream (latency = time to the first piece of text)")
+args = ap.parse_args()
+
+questions = [json.loads(l)["q"] for l in open(ROOT / "eval" / "qas.jsonl", encoding="utf-8")]
+mock = serve_mock_ollama(0, tokens=args.tokens, token_s=args.token_ms / 1000)
+base_cfg = yaml.safe_load(open(args.config, encoding="utf-8"))
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Server in its own process, so the load generator doesn't compete with it for the GIL
+def start_server(max_batch: int):
+    cfg = {**base_cfg,
+           "llm": {**base_cfg["llm"], "provider": "ollama", "max_concurrency": args.llm_concurrency},
+           "embeddings": {**base_cfg["embeddings"], "cache_size": 0, "cache_path": None},
+           "answer_cache": {"enabled": False},
+           "serve": {**base_cfg.get("serve", {}), "max_batch": max_batch, "max_wait_ms": args.max_wait_ms, "warm_up": True}}
+    path = Path(tempfile.mkstemp(suffix=".yaml")[1]) # relative paths in it still resolve against the working directory
+    path.write_text(yaml.safe_dump(cfg), encoding="utf-8")
+    port = free_port()
+    env = {**os.environ, "OLLAMA_HOST": f"http://127.0.0.1:{mock.server_address[1]}"}
+    proc = subprocess.Popen([sys.executable, str(ROOT / "serve.py"), "--config", str(path), "--port", str(port)], env=env, cwd=os.getcwd())
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(600): # model load + warm-up
+        try:
+            requests.get(f"{url}/healthz", timeout=1).raise_for_status()
+            return proc, url, path
+        except requests.RequestException:
+            if proc.poll() is not None:
+                raise SystemExit("server exited during startup")
+            time.sleep(0.5)
+    raise SystemExit("server did not come up")
+
+local = threading.local()
+
+def session() -> requests.Session: # keep-alive connection per client thread
+    if not hasattr(local, "session"):
+        local.session = requests.Session()
+    return local.session
+
+def ask(url: str, question: str, due: float) -> tuple[float, bool]:
+    try:
+        if args.stream:
+            first = None
+            with session().post(f"{url}/answer/stream", json={"question": question}, stream=True, timeout=120) as r:
+                r.raise_for_status()
+                for line in r.iter_lines(): # read to the end, the answer is still generated in full
+                    if first is None and line and "delta" in json.loads(line):
+                        first = time.perf_counter()
+            return (first or time.perf_counter()) - due, True
+        session().post(f"{url}/answer", json={"question": question}, timeout=120).raise_for_status()
+        return time.perf_counter() - due, True
+    except requests.RequestException:
+        return time.perf_counter() - due, False
+
+def run(url: str, qps: float) -> dict:
+    n = int(qps * args.duration)
+    t0 = time.perf_counter()
+    futures = []
+    with ThreadPoolExecutor(max_workers=512) as pool: # enough clients that sending rarely waits for answers
+        for i in range(n):
+            due = t0 + i / qps
+            time.sleep(max(0.0, due - time.perf_counter()))
+            futures.append(pool.submit(ask, url, questions[i % len(questions)], due))
+        results = [f.result() for f in futures]
+    elapsed = time.perf_counter() - t0
+    lat = np.array([s for s, ok in results if ok]) * 1000
+    return {"sent": n, "ok": len(lat), "rps": len(lat) / elapsed,
+            **({f"p{p}": float(np.percentile(lat, p)) for p in (50, 95, 99)} if len(lat) else {"p50": 0.0, "p95": 0.0, "p99": 0.0})}
+
+print(f"{len(questions)} questions, {args.duration:.0f}s per rate, mock LLM {args.tokens} tokens x {args.token_ms} ms, "
+      f"{'stream (time to first text)' if args.stream else 'JSON (full answer)'}")
+print(f"{'max_batch':>9} {'target qps':>10} {'achieved':>9} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'mean batch':>11}")
+for max_batch in args.max_batch:
+    proc, url, path = start_server(max_batch)
+    try:
+        for qps in args.qps:
+            before = requests.get(f"{url}/healthz").json()
+            r = run(url, qps)
+            after = requests.get(f"{url}/healthz").json()
+            mean_batch = (after["batched"] - before["batched"]) / max(1, after["batches"] - before["batches"])
+            print(f"{max_batch:>9} {qps:>10.0f} {r['rps']:>9.1f} {r['sent'] - r['ok']:>7} {r['p50']:>8.1f} {r['p95']:>8.1f} {r['p99']:>8.1f} {mean_batch:>11.2f}")
+    finally:
+        proc.terminate()
+        proc.wait()
+        path.unlink()
+mock.shutdown()
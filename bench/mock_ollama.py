@@ -0,0 +1,77 @@
+# Local stand-in for Ollama's /api/generate (streaming NDJSON and non-streaming), for tests and benchmarks
+#
+#   python bench/mock_ollama.py --port 11434 --tokens 64 --token-ms 20
+#   OLLAMA_HOST=http://127.0.0.1:11434 streamlit run app.py
+
+import json, time, argparse, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Start the mock on localhost (port 0 = any free port); each answer is `tokens` words, one every `token_s` seconds.
+# With fail_every=k every k-th request is answered with 503, to exercise client retries.
+def serve_mock_ollama(port: int = 0, tokens: int = 64, token_s: float = 0.02, prefill_s: float = 0.0, fail_every: int = 0) -> ThreadingHTTPServer:
+    counter, lock = [0], threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True # headers and body are separate writes: avoid delayed-ACK stalls on keep-alive connections
+
+        def do_POST(self):
+            if self.path != "/api/generate":
+                self.send_error(404)
+                return
+            req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            with lock:
+                counter[0] += 1
+                fail = fail_every > 0 and counter[0] % fail_every == 0
+            if fail:
+                self.send_error(503, "overloaded")
+                return
+            limit = req.get("options", {}).get("num_predict", -1)
+            n = tokens if limit is None or limit < 0 else min(tokens, limit)
+            words = [f"tok{i} " for i in range(n)]
+            time.sleep(prefill_s) # prompt evaluation before the first token
+            if req.get("stream", True): # Ollama streams by default
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for w in words:
+                    time.sleep(token_s)
+                    self._chunk({"model": req.get("model"), "response": w, "done": False})
+                self._chunk({"model": req.get("model"), "response": "", "done": True, "eval_count": n})
+                self.wfile.write(b"0\r\n\r\n")
+            else:
+                time.sleep(token_s * n)
+                body = json.dumps({"model": req.get("model"), "response": "".join(words), "done": True, "eval_count": n}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def _chunk(self, obj):
+            data = (json.dumps(obj) + "\n").encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def log_message(self, *args): pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=11434)
+    ap.add_argument("--tokens", type=int, default=64)
+    ap.add_argument("--token-ms", type=float, default=20)
+    ap.add_argument("--prefill-ms", type=float, default=0)
+    ap.add_argument("--fail-every", type=int, default=0, help="Answer every k-th request with 503")
+    args = ap.parse_args()
+    server = serve_mock_ollama(args.port, args.tokens, args.token_ms / 1000, args.prefill_ms / 1000, args.fail_every)
+    print(f"Mock Ollama on http://127.0.0.1:{server.server_address[1]} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
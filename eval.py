@@ -1,13 +1,16 @@
-import json, csv, re
+import json, csv, re, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import argparse
 
 from raglab.config import Settings
-from raglab.embed import Embedder
-from raglab.index import FaissIndex
+from raglab.embed import CachedEmbedder
+from raglab.index import serving_config
+from raglab.shards import open_index
 from raglab.retrieve import Retriever
-from raglab.pipeline import ChatRAG
+from raglab.pipeline import ChatRAG, NO_ANSWER
 from raglab.llm import LLM
+from raglab import metrics
 
 
 # ---------- Smarter matching utilities ----------
@@ -52,46 +55,112 @@ def match_gold(answer: str, gold) -> bool:
     return normalize(str(gold)) in normalize(answer)
 
 
-# ---------- Main script ----------
+# ---------- Runner ----------
 
-ap = argparse.ArgumentParser()
-ap.add_argument("--config", required=True, help="Path to config YAML (e.g., config/config.yaml)")
-args = ap.parse_args()
+COLUMNS = ["id", "strategy", "question", "expected", "answer", "correct", "retrieval_ms", "mmr_ms", "generation_ms", "prompt_tokens"]
 
-cfg = Settings.load(args.config)
 
-# Load retriever + LLM stack
-embedder = Embedder(cfg.embeddings["model_name"], cfg.embeddings["batch_size"])
-ix = FaissIndex(cfg.index["faiss_path"], cfg.index["meta_path"])
-ix.load()
-retriever = Retriever(ix, embedder, cfg.retriever["top_k"], cfg.retriever["use_mmr"], cfg.retriever["mmr_lambda"])
-llm = LLM(**cfg.llm)
-rag = ChatRAG(retriever, llm, cfg.retriever["min_score"])
-
-# Load eval set
-qas_path = Path("eval/qas.jsonl")
-qas = [json.loads(line) for line in qas_path.open("r", encoding="utf-8")]
-
-rows = [("id", "strategy", "question", "expected", "answer", "correct")]
-
-for i, qa in enumerate(qas, 1):
-    q = qa["q"]
-    gold = qa["a"]
-
-    # Baseline: no retrieval context
-    base_answer = llm.generate(q).strip()
-    base_ok = match_gold(base_answer, gold)
-    rows.append((i, "no_ctx", q, json.dumps(gold, ensure_ascii=False), base_answer, base_ok))
-
-    # RAG: with retrieved context
-    out = rag.answer(q)
-    rag_answer = out["answer"].strip()
-    rag_ok = match_gold(rag_answer, gold)
-    rows.append((i, "rag", q, json.dumps(gold, ensure_ascii=False), rag_answer, rag_ok))
+def load_done(path: Path) -> set:
+    """
+    (id, strategy) pairs already in the results file, so an interrupted run resumes where it stopped.
+    """
+    if not path.exists() or path.stat().st_size == 0:
+        return set()
+    with path.open("r", newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames != COLUMNS:
+            raise SystemExit(f"{path} was written by an older eval (columns {reader.fieldnames}); rerun with --fresh")
+        return {(r["id"], r["strategy"]) for r in reader}
 
-# Save results
-Path("eval").mkdir(exist_ok=True)
-with open("eval/results.csv", "w", newline="", encoding="utf-8") as f:
-    csv.writer(f).writerows(rows)
 
-print("Saved eval/results.csv")
+def run_job(llm, sizer, job: dict) -> list:
+    """
+    Generate one answer (runs on a worker thread) and return its CSV row.
+    """
+    answer, gen_ms, prompt_tokens = job["fallback"], 0.0, 0
+    if job["prompt"] is not None:
+        t0 = time.perf_counter()
+        answer = llm.generate(job["prompt"])
+        gen_ms = (time.perf_counter() - t0) * 1000
+        prompt_tokens = sizer.count(job["prompt"])
+    answer = answer.strip()
+    return [job["id"], job["strategy"], job["question"], json.dumps(job["gold"], ensure_ascii=False), answer,
+            match_gold(answer, job["gold"]), f"{job['retrieval_ms']:.1f}", f"{job['mmr_ms']:.1f}", f"{gen_ms:.1f}", prompt_tokens]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--config", required=True, help="Path to config YAML (e.g., config/config.yaml)")
+    ap.add_argument("--out", default="eval/results.csv", help="Append-only results file (resumed if it exists)")
+    ap.add_argument("--concurrency", type=int, default=4, help="Max LLM requests in flight")
+    ap.add_argument("--fresh", action="store_true", help="Discard existing results instead of resuming")
+    args = ap.parse_args()
+
+    cfg = Settings.load(args.config)
+    metrics.configure(cfg.metrics)
+
+    # Load retriever + LLM stack
+    embedder = CachedEmbedder.from_config(cfg.embeddings) # query embeddings are cached across requests and runs
+    index_cfg = serving_config(cfg.index) # same index files as the app
+    ix = open_index(index_cfg)
+    retriever = Retriever.from_config(cfg.retriever, ix, embedder, index_cfg.get("lexical_path"))
+    llm = LLM(**{**cfg.llm, "max_concurrency": args.concurrency}) # connection pool sized for the eval's workers
+    rag = ChatRAG(retriever, llm, cfg.retriever["min_score"], context_tokens=cfg.retriever.get("context_tokens"))
+    sizer = rag.sizer
+
+    # Load eval set
+    qas_path = Path("eval/qas.jsonl")
+    qas = [json.loads(line) for line in qas_path.open("r", encoding="utf-8")]
+
+    out_path = Path(args.out)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    if args.fresh and out_path.exists():
+        out_path.unlink()
+    done = load_done(out_path)
+
+    jobs = []
+    for i, qa in enumerate(qas, 1):
+        # Baseline: no retrieval context
+        if (str(i), "no_ctx") not in done:
+            jobs.append({"id": i, "strategy": "no_ctx", "question": qa["q"], "gold": qa["a"], "prompt": qa["q"], "fallback": "", "retrieval_ms": 0.0, "mmr_ms": 0.0})
+
+    # RAG: with retrieved context, retrieval for the whole pending set in one batch
+    pending = [(i, qa) for i, qa in enumerate(qas, 1) if (str(i), "rag") not in done]
+    timings = {}
+    hits = retriever.retrieve_batch([qa["q"] for _, qa in pending], timings=timings)
+    per_q = 1000 / max(len(pending), 1) # batch stage time, amortized per question
+    for (i, qa), (docs, scores) in zip(pending, hits):
+        prompt, _ = rag.build_prompt(qa["q"], docs, scores)
+        jobs.append({"id": i, "strategy": "rag", "question": qa["q"], "gold": qa["a"], "prompt": prompt, "fallback": NO_ANSWER,
+                     "retrieval_ms": (timings["lexical"] + timings["embed"] + timings["search"]) * per_q, "mmr_ms": timings["mmr"] * per_q})
+    print(f"{len(done)} result(s) already in {out_path}, {len(jobs)} to run")
+
+    # Generate with at most `concurrency` requests in flight; every finished row is appended and flushed immediately
+    with out_path.open("a", newline="", encoding="utf-8") as f, ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        writer = csv.writer(f)
+        if f.tell() == 0: # new file
+            writer.writerow(COLUMNS)
+        futures = {pool.submit(run_job, llm, sizer, job): job for job in jobs}
+        failed = 0
+        try:
+            for n, fut in enumerate(as_completed(futures), 1):
+                try:
+                    row = fut.result()
+                except Exception as e: # no row: the next run retries this job
+                    failed += 1
+                    job = futures[fut]
+                    print(f"\nJob {job['id']}/{job['strategy']} failed: {type(e).__name__}: {e}")
+                    continue
+                writer.writerow(row)
+                f.flush()
+                print(f"[{n}/{len(jobs)}]", end="\r")
+        except BaseException: # e.g. Ctrl-C: don't wait for every queued LLM call whose answer would be lost
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    metrics.export()
+    print(f"Saved {out_path}" + (f", {failed} job(s) failed and will be retried on the next run" if failed else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,171 @@
 from pathlib import Path
 import json
+import numpy as np
 from raglab.config import Settings
 from raglab.scrape import crawl
-from raglab.chunk import chunk_docs
-from raglab.embed import Embedder
+from raglab.chunk import chunk_docs, CHUNKER_VERSION
+from raglab.embed import make_embedder
+from raglab.bulk_embed import BulkEmbedder
 from raglab.index import FaissIndex
+from raglab.shards import check_partition, write_shards
+from raglab.manifest import Manifest, content_hash
+from raglab.lexical import LexicalIndex
+from raglab import metrics
 from tqdm import tqdm
 
 import argparse
 
-ap = argparse.ArgumentParser() 
+ap = argparse.ArgumentParser()
 ap.add_argument("--config", required=True)
-ap = ap.parse_args()
-
-cfg = Settings.load(ap.config)
-seeds = [l.strip() for l in open(cfg.seeds_file, "r", encoding="utf-8") if l.strip()]
-
-# 1. Crawl
-docs = crawl(seeds, cfg.seed_domain, Path("data"), max_pages=cfg.scrape["max_pages"], same_domain_only=cfg.scrape["same_domain_only"])
-Path("data/processed").mkdir(parents=True, exist_ok=True)
-with open("data/processed/docs.jsonl", "w", encoding="utf-8") as f:
-    for doc in docs:
-        f.write(json.dumps(doc, ensure_ascii=False) + "\n") # one json doc per line
-
-# 2. Chunk
-chunks = chunk_docs(docs, target_tokens=cfg.chunk["target_tokens"], overlap_tokens=cfg.chunk["overlap_tokens"])
-Path("data/chunks").mkdir(exist_ok=True)
-with open("data/processed/chunks.jsonl", "w", encoding="utf-8") as f:
-    for chunk in chunks:
-        f.write(json.dumps(chunk, ensure_ascii=False) + "\n") # one json chunk per line
-
-# 3. Embed
-embedder = Embedder(cfg.embeddings["model_name"], cfg.embeddings["batch_size"]) # Initialize embedder
-texts = [chunk["text"] for chunk in chunks] # Extract texts from chunks
-X = embedder.encode(texts) # Get embeddings
-
-# 4. Index
-meta = [{"url": chunk["url"], "title": chunk.get("title", ""), "text": chunk["text"][:2000]} for chunk in chunks] # Extract metadata from chunks
-ix = FaissIndex(cfg.index["faiss_path"], cfg.index["meta_path"]) # Initialize index
-ix.build(X, meta) # Build index
-ix.save() # Save index
-print(f"Ingest complete. {len(meta)} chunks indexed")
\ No newline at end of file
+ap.add_argument("--full", action="store_true", help="Ignore the manifest and rebuild the index from scratch (needed to switch index type)")
+ap.add_argument("--snapshot", action="store_true", help="Write the memory-mapped serving snapshot (index.snapshot_dir); once it exists every ingest refreshes it")
+
+def main():
+    args = ap.parse_args()
+    cfg = Settings.load(args.config)
+    metrics.configure(cfg.metrics)
+    stages = [] # throughput of every stage, reported at the end
+    seeds = [l.strip() for l in open(cfg.seeds_file, "r", encoding="utf-8") if l.strip()]
+
+    # 0. Manifest of the previous ingest (url -> content hash, validators, chunk ids)
+    ix = FaissIndex.from_config(cfg.index) # Initialize index
+    settings = {"model_name": cfg.embeddings["model_name"], "target_tokens": cfg.chunk["target_tokens"], "overlap_tokens": cfg.chunk["overlap_tokens"],
+                "chunker": CHUNKER_VERSION} # Changing any of these invalidates every stored chunk
+    variant = make_embedder(cfg.embeddings).variant # nothing is loaded here
+    if variant != cfg.embeddings["model_name"]: # non-default backend (e.g. int8 ONNX): its vectors don't mix with torch ones
+        settings["embedder"] = variant
+    manifest = Manifest.load(cfg.index.get("manifest_path", "index/manifest.json"), settings)
+    incremental = not args.full and bool(manifest.pages) and ix.index_path.exists()
+    orphans = set() # ids in the index that no page of the manifest owns
+    if incremental:
+        ix.load()
+        # An ingest that failed between saving the index and the manifest leaves ids the manifest doesn't know:
+        # never hand them out again, and drop them from the index (their pages are redone below)
+        known = {cid for p in manifest.pages.values() for _, cid in p["chunks"]}
+        orphans = set(ix.ids.tolist()) - known
+        if len(ix.ids):
+            manifest.next_id = max(manifest.next_id, int(ix.ids.max()) + 1)
+    else:
+        manifest = Manifest(manifest.path, settings)
+
+    # 1. Crawl (conditional GETs for pages we already have); documents stream to disk, only hashes stay in memory
+    docs = crawl(seeds, cfg.seed_domain, Path("data"), max_pages=cfg.scrape["max_pages"], same_domain_only=cfg.scrape["same_domain_only"], validators=manifest.validators(),
+                 timeout=cfg.scrape["timeout_sec"], concurrency=cfg.scrape.get("concurrency", 1), per_host_rps=cfg.scrape.get("per_host_rps", 0),
+                 extract_workers=cfg.scrape.get("extract_workers"))
+    docs_path = Path("data/processed/docs.jsonl")
+    docs_path.parent.mkdir(parents=True, exist_ok=True)
+    pages = {} # url -> {"hash", "etag", "last_modified"}
+    with open(docs_path, "w", encoding="utf-8") as f, metrics.stage("ingest_crawl") as st:
+        for doc in docs:
+            f.write(json.dumps(doc, ensure_ascii=False) + "\n") # one json doc per line
+            pages[doc["url"]] = {"hash": content_hash(doc["text"]), "etag": doc.get("etag"), "last_modified": doc.get("last_modified")}
+            st.items += 1
+    stages.append(st)
+
+    if not pages: # e.g. network down: don't treat every indexed page as removed
+        raise SystemExit("Crawl returned no documents, keeping the existing index")
+
+    # Pages whose text changed (or are new) need re-chunking; pages no longer crawled are dropped
+    crawled = set(pages)
+    changed_urls = {url for url, p in pages.items() if manifest.pages.get(url, {}).get("hash") != p["hash"]}
+    gone = [url for url in manifest.pages if url not in crawled]
+    print(f"{len(changed_urls)} new/changed page(s), {len(pages) - len(changed_urls)} unchanged, {len(gone)} removed")
+
+    # 2. Chunk (only changed pages, streamed back from docs.jsonl; chunks.jsonl holds the chunks processed by this run)
+    changed = (d for d in map(json.loads, open(docs_path, "r", encoding="utf-8")) if d["url"] in changed_urls)
+    chunks = chunk_docs(changed, target_tokens=cfg.chunk["target_tokens"], overlap_tokens=cfg.chunk["overlap_tokens"], workers=cfg.chunk.get("workers", 0))
+    Path("data/chunks").mkdir(exist_ok=True)
+    chunks_file = open("data/processed/chunks.jsonl", "w", encoding="utf-8")
+
+    # Match new chunks against the old ones as they stream in: same page, position and text keeps its id, same text elsewhere reuses its vector
+    page_chunks = {url: manifest.pages[url]["chunks"] for url in crawled - changed_urls} # unchanged pages keep everything
+    page_chunks.update({url: [] for url in changed_urls})
+    old_ids = {cid for url in changed_urls | set(gone) for cid in manifest.chunk_ids(url)} # ids of pages being redone
+    by_hash = {h: cid for p in manifest.pages.values() for h, cid in p["chunks"]} # any stored vector, by chunk text
+    kept_ids, add, reuse = set(), [], [] # add: (chunk, id) needing a vector; reuse: (chunk, id, id of the stored vector)
+    with metrics.stage("ingest_chunk") as st: # chunking runs lazily inside this loop
+        for chunk in chunks:
+            st.items += 1
+            chunks_file.write(json.dumps(chunk, ensure_ascii=False) + "\n") # one json chunk per line
+            h = content_hash(chunk["text"])
+            old = manifest.pages.get(chunk["url"], {}).get("chunks", []) # in page order: list index == stored pos
+            if chunk["pos"] < len(old) and old[chunk["pos"]][0] == h: # untouched chunk of a changed page: nothing to do in the index
+                cid = old[chunk["pos"]][1]
+                kept_ids.add(cid)
+            else:
+                cid = manifest.new_id()
+                if h in by_hash:
+                    reuse.append((chunk, cid, by_hash[h]))
+                else:
+                    add.append((chunk, cid))
+            page_chunks[chunk["url"]].append([h, cid])
+    stages.append(st)
+    chunks_file.close()
+    remove_ids = sorted((old_ids - kept_ids) | orphans)
+    n_shards, shards_dir = cfg.index.get("shards", 1), cfg.index.get("shards_dir")
+    if n_shards > 1 and shards_dir: # fail before anything is embedded or saved
+        kept = np.setdiff1d(ix.ids, remove_ids) if incremental else np.zeros(0, dtype=np.int64)
+        try:
+            check_partition(np.concatenate([kept, [cid for _, cid in add], [cid for _, cid, _ in reuse]]), n_shards) # ids after this run
+        except ValueError as e:
+            raise SystemExit(f"index.shards: {e}; lower it")
+
+    # 3. Embed (the model is only loaded if some chunk text is in neither the index nor the embedding cache)
+    vecs = []
+    embedder = BulkEmbedder.from_config(cfg.embeddings) # length-bucketed shards, worker processes, resumable
+    with metrics.stage("ingest_embed") as st:
+        if add:
+            texts = [chunk["text"] for chunk, _ in add] # Extract texts from chunks
+            vecs.append(np.asarray(embedder.run(texts), dtype="float32")) # Get embeddings
+            st.items = len(add)
+    stages.append(st)
+    if reuse: # copy stored vectors of identical chunk texts
+        vecs.append(np.asarray(ix.vectors[np.searchsorted(ix.ids, [src for _, _, src in reuse])], dtype="float32"))
+    X = np.concatenate(vecs) if vecs else np.zeros((0, ix.vectors.shape[1] if incremental else 0), dtype="float32")
+    new = add + [(chunk, cid) for chunk, cid, _ in reuse]
+    resumed = f", {embedder.resumed} shard(s) from the checkpoint" if embedder.resumed else ""
+    print(f"{len(add)} chunk(s) embedded{f' ({embedder.counts}{resumed})' if add else ''}, {len(reuse)} reused, {len(remove_ids)} removed")
+
+    # 4. Index
+    meta = [{"url": chunk["url"], "title": chunk.get("title", ""), "text": chunk["text"][:2000], "pos": chunk["pos"]} for chunk, _ in new] # Extract metadata from chunks
+    ids = [cid for _, cid in new]
+    with metrics.stage("ingest_index") as st:
+        if not incremental:
+            ix.build(X, meta, ids) # Build index
+            ix.save() # Save index
+        elif new or remove_ids:
+            ix.update(X, meta, ids, remove_ids) # add_with_ids / remove_ids, unchanged chunks are untouched
+            ix.save() # Save index
+        st.items = len(new) + len(remove_ids)
+    stages.append(st)
+    manifest.pages = {url: {**p, "chunks": page_chunks[url]} for url, p in pages.items()}
+    manifest.save() # right after the index it describes, before the artifacts derived from it
+    lexical_path = cfg.index.get("lexical_path")
+    if lexical_path and (new or remove_ids or not Path(lexical_path).exists()): # BM25 over all indexed chunks, same ids as FAISS
+        with metrics.stage("ingest_lexical") as st:
+            LexicalIndex.build((m["text"] for m in ix.meta), ix.ids).save(lexical_path)
+            st.items = len(ix.ids)
+        stages.append(st)
+    if n_shards > 1 and shards_dir:
+        manifest_file = Path(shards_dir) / "shards.json"
+        if new or remove_ids or not manifest_file.exists() or json.loads(manifest_file.read_text(encoding="utf-8"))["n"] != n_shards:
+            with metrics.stage("ingest_shards") as st:
+                write_shards(ix, shards_dir, n_shards) # id % n partitions, each with its own FAISS index and metadata
+                st.items = len(ix.ids)
+            stages.append(st)
+    snapshot_dir = cfg.index.get("snapshot_dir")
+    if args.snapshot and not snapshot_dir:
+        raise SystemExit("--snapshot needs index.snapshot_dir in the config")
+    if snapshot_dir and (args.snapshot or (Path(snapshot_dir).exists() and (new or remove_ids))):
+        with metrics.stage("ingest_snapshot") as st:
+            ix.save_snapshot(snapshot_dir, {"bm25.npz": lexical_path} if lexical_path else None)
+            st.items = len(ix.ids)
+        stages.append(st)
+    embedder.cleanup() # vectors are in the index now
+    print(f"Ingest complete. {len(ix.ids)} chunks indexed")
+    print("Throughput:", " | ".join(map(str, stages)))
+    metrics.export()
+
+# Guard: the crawler's extraction workers may re-import this module (spawn start method)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Dynamic micro-batching for asyncio servers: concurrent callers each submit one item, the batcher groups whatever
+# arrives within max_wait_ms (at most max_batch items) and runs one batched call on a worker thread.
+# Under load the next batch fills while the previous one runs, so batches grow with traffic; an idle server
+# adds at most max_wait_ms to a request.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Generic, List, TypeVar
+from . import metrics
+
+In = TypeVar("In")
+Out = TypeVar("Out")
+
+class MicroBatcher(Generic[In, Out]):
+    # fn maps a list of items to a list of results in the same order; it runs on a single dedicated thread,
+    # so it never waits behind other blocking work (LLM calls) in the event loop's default executor
+    def __init__(self, fn: Callable[[List[In]], List[Out]], max_batch: int = 32, max_wait_ms: float = 5.0, name: str = "batch"):
+        self.fn = fn
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self.queue: asyncio.Queue | None = None
+        self.task: asyncio.Task | None = None
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.batches = self.items = 0 # mean batch size = items / batches
+
+    # Start collecting (call from the running event loop, e.g. in the app's startup)
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.pool.shutdown(wait=False)
+
+    # Result for one item, computed as part of the next batch
+    async def submit(self, item: In) -> Out:
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, fut))
+        return await fut
+
+    async def _collect(self) -> list:
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(batch) < self.max_batch:
+            if not self.queue.empty(): # already waiting: no need to sleep
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [(item, fut) for item, fut in await self._collect() if not fut.done()] # skip callers that gave up
+            if not batch:
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            metrics.observe(f"{self.name}_size", len(batch))
+            try:
+                results = await loop.run_in_executor(self.pool, self.fn, [item for item, _ in batch])
+            except Exception as exc: # the whole batch fails together
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(exc)
+                continue
+            for (_, fut), result in zip(batch, results):
+                if not fut.done():
+                    fut.set_result(result)
@@ -0,0 +1,118 @@
+# Embedding stage for ingest: many chunk texts into one float32 matrix, in parallel and resumable.
+# Texts are sorted by length and cut into fixed-size shards, so every batch pads to similar lengths; shards are encoded
+# by a pool of worker processes (each with its own model and embedding cache) and written into a memory-mapped .npy
+# as they finish. A checkpoint lists the finished shards: after a crash, the next run with the same texts and model
+# only encodes the missing ones. Ties are broken by content hash and the file holds rows in that sorted order, so the
+# order texts arrive in (crawl completion order) changes neither the shards nor the checkpoint.
+
+import os, json, shutil, hashlib, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List
+import numpy as np
+from .embed import CachedEmbedder, OnnxEmbedder, make_embedder
+
+_worker: CachedEmbedder | None = None # embedder of a pool process
+
+def _init_worker(emb_cfg: Dict, threads: int):
+    global _worker
+    os.environ.setdefault("OMP_NUM_THREADS", str(threads)) # before torch is imported: workers share the cores
+    emb_cfg = {**emb_cfg, "threads": emb_cfg.get("threads") or threads} # onnx backend
+    _worker = CachedEmbedder.from_config(emb_cfg)
+
+def _encode(embedder: CachedEmbedder, texts: List[str]) -> tuple[np.ndarray, Dict[str, int]]:
+    before = embedder.stats()
+    X = np.asarray(embedder.encode(texts), dtype=np.float32)
+    after = embedder.stats()
+    return X, {k: after[k] - before[k] for k in ("hits", "disk_hits", "misses")}
+
+def _encode_shard(texts: List[str]) -> tuple[np.ndarray, Dict[str, int]]:
+    return _encode(_worker, texts)
+
+class BulkEmbedder:
+    # workers=0 encodes in this process; bucket=False orders by content hash only, no length buckets (for comparison)
+    def __init__(self, emb_cfg: Dict, work_dir: str = "index/embed_work", shard_size: int = 1024, workers: int = 0, bucket: bool = True):
+        self.emb_cfg = emb_cfg
+        self.dir = Path(work_dir)
+        self.shard_size = max(1, shard_size)
+        self.workers = workers
+        self.bucket = bucket
+        self.counts = {"hits": 0, "disk_hits": 0, "misses": 0}
+        self.resumed = 0 # shards taken from the checkpoint
+
+    # Create the stage from the `embeddings:` section of the config
+    @staticmethod
+    def from_config(emb_cfg: Dict) -> "BulkEmbedder":
+        return BulkEmbedder(emb_cfg, emb_cfg.get("work_dir", "index/embed_work"), emb_cfg.get("shard_size", 1024), emb_cfg.get("workers", 0))
+
+    # Identifies a run: same texts (in sorted order, see run), same model and sharding -> the checkpoint applies
+    def _key(self, digests: List[bytes]) -> str:
+        variant = make_embedder(self.emb_cfg).variant # nothing is loaded here
+        h = hashlib.sha1(f"{variant}\0{self.shard_size}\0{self.bucket}".encode("utf-8"))
+        for d in digests:
+            h.update(d)
+        return h.hexdigest()
+
+    def _load_checkpoint(self, key: str) -> set:
+        path = self.dir / "checkpoint.json"
+        if path.exists() and (self.dir / "vectors.npy").exists():
+            ckpt = json.loads(path.read_text(encoding="utf-8"))
+            if ckpt.get("key") == key:
+                return set(ckpt["done"])
+        shutil.rmtree(self.dir, ignore_errors=True) # another run's leftovers
+        return set()
+
+    def _save_checkpoint(self, key: str, done: set):
+        tmp = self.dir / "checkpoint.json.tmp"
+        tmp.write_text(json.dumps({"key": key, "done": sorted(done)}), encoding="utf-8")
+        tmp.replace(self.dir / "checkpoint.json") # atomic: a crash leaves the previous checkpoint
+
+    # Vectors for texts, rows in input order
+    def run(self, texts: List[str]) -> np.ndarray:
+        n = len(texts)
+        digests = [hashlib.sha1(t.encode("utf-8")).digest() for t in texts]
+        order = sorted(range(n), key=(lambda i: (len(texts[i]), digests[i])) if self.bucket else digests.__getitem__) # length buckets
+        shards = [order[i:i + self.shard_size] for i in range(0, n, self.shard_size)] # shard s: rows s * shard_size... of the file
+        key = self._key([digests[i] for i in order])
+        done = self._load_checkpoint(key)
+        self.resumed = len(done)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        out_path = self.dir / "vectors.npy"
+        out = np.load(out_path, mmap_mode="r+") if done else None
+        todo = [s for s in range(len(shards)) if s not in done][::-1] # bucketed: longest shards first, so the pool finishes evenly
+
+        def write(s: int, X: np.ndarray, counts: Dict[str, int]):
+            nonlocal out
+            if out is None: # the dimension is known once the first shard is encoded
+                out = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.float32, shape=(n, X.shape[1]))
+            out[s * self.shard_size:s * self.shard_size + len(X)] = X
+            out.flush() # vectors on disk before the checkpoint says so
+            done.add(s)
+            self._save_checkpoint(key, done)
+            for k in self.counts:
+                self.counts[k] += counts[k]
+
+        if todo and self.workers <= 0:
+            embedder = CachedEmbedder.from_config(self.emb_cfg)
+            for s in todo:
+                write(s, *_encode(embedder, [texts[i] for i in shards[s]]))
+        elif todo:
+            model = make_embedder(self.emb_cfg)
+            if isinstance(model, OnnxEmbedder): # export once here; the workers only load the files
+                OnnxEmbedder.export(model.model_name, model.dir, model.quantize)
+            threads = max(1, (os.cpu_count() or 1) // self.workers)
+            start = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn" # ingest may run threads (metrics server)
+            with ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(start), initializer=_init_worker, initargs=(self.emb_cfg, threads)) as pool:
+                futures = {pool.submit(_encode_shard, [texts[i] for i in shards[s]]): s for s in todo}
+                for f in as_completed(futures):
+                    write(futures[f], *f.result())
+        if out is None: # no texts
+            return np.zeros((0, 0), dtype=np.float32)
+        del out # flush and close the writable map
+        rows = np.empty(n, dtype=np.int64)
+        rows[order] = np.arange(n) # row of each input text in the file
+        return np.load(out_path, mmap_mode="r")[rows]
+
+    # Drop the output and checkpoint once the vectors are safely in the index
+    def cleanup(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
@@ -1,42 +1,103 @@
 # Utility functions for chunking documents into smaller pieces based on token counts
 
-from typing import List, Dict
-import re
+from typing import Dict, Iterable, Iterator, List
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import re, multiprocessing
 import tiktoken
 
+CHUNKER_VERSION = 3 # Bump when chunk boundaries change, so stored chunks are rebuilt
+
 # Split paragraphs based on double newlines
 def split_paragraphs(text: str) -> list[str]:
     parts = re.split(r"\n{2,}", text)
     return [p.strip() for p in parts if p.strip()]
 
+# Tokenizers are expensive to load: one per encoding name and process
+@lru_cache(maxsize=None)
+def get_encoding(model: str = "cl100k_base"):
+    return tiktoken.get_encoding(model)
+
+# Encoding of an LLM for prompt budgets; models tiktoken doesn't know (Ollama tags like llama3.1:8b) get cl100k_base
+def encoding_for(model: str) -> str:
+    try:
+        return tiktoken.encoding_for_model(model).name
+    except KeyError:
+        return "cl100k_base"
+
 # Class for counting tokens in text
 class TokenSizer:
     def __init__(self, model: str = "cl100k_base"): # Default model
-        self.enc = tiktoken.get_encoding(model) # Initialize tokenizer for the specified model
+        self.enc = get_encoding(model) # Initialize tokenizer for the specified model (cached)
     def count(self, s: str) -> int:
-        return len(self.enc.encode(s)) # Return token count for the string
-    
-def chunk_docs(docs: List[Dict], target_tokens=800, overlap_tokens=120):
-    sizer = TokenSizer()
+        return len(self.enc.encode_ordinary(s)) # Return token count for the string
+    def encode_batch(self, texts: List[str]) -> List[List[int]]:
+        return self.enc.encode_ordinary_batch(texts) # All paragraphs of a document in one call
+    def decode(self, tokens: List[int]) -> str:
+        return self.enc.decode(tokens)
+    # Whether cutting before tokens[i] keeps characters whole (a token can start in the middle of a multi-byte character)
+    def is_boundary(self, tokens: List[int], i: int) -> bool:
+        return i <= 0 or i >= len(tokens) or self.enc.decode_single_token_bytes(tokens[i])[0] & 0xC0 != 0x80
+
+# Chunk one document; every paragraph is tokenized exactly once and all sizes come from token offsets
+def chunk_doc(d: Dict, target_tokens=800, overlap_tokens=120, model: str = "cl100k_base") -> List[Dict]:
+    sizer = TokenSizer(model)
+    paras = split_paragraphs(d['text'])
+    pieces = [] # (text, tokens) units no larger than target_tokens
+    for para, toks in zip(paras, sizer.encode_batch(paras)):
+        if len(toks) <= target_tokens:
+            pieces.append((para, toks))
+            continue
+        s = 0 # Oversized paragraph: windows of target_tokens with overlap_tokens overlap, cut between characters
+        while True:
+            e = min(s + target_tokens, len(toks))
+            while e > s + 1 and not sizer.is_boundary(toks, e):
+                e -= 1
+            window = toks[s:e]
+            pieces.append((sizer.decode(window), window))
+            if e >= len(toks):
+                break
+            s = max(s + 1, e - overlap_tokens)
+            while s < e and not sizer.is_boundary(toks, s):
+                s += 1
+
     chunks = []
-    for d in docs:
-        paras = split_paragraphs(d['text'])
-        buf, buf_tokens = [], 0
-        for para in paras:
-            t = sizer.count(para)
-            if buf_tokens + t > target_tokens and buf: # If adding this paragraph exceeds target and buffer is not empty
-                chunk_text = "\n\n".join(buf) # Join paragraphs with double newlines
-                chunks.append({"url": d["url"], "title": d.get("title", ""), "text": chunk_text})
-                # Start new buffer with overlap from the end
-                if overlap_tokens > 0 and buf:
-                    tail = buf[-1]
-                    buf = [tail] if sizer.count(tail) <= overlap_tokens else [] # Keep last paragraph if it fits in overlap
-                    buf_tokens = sum(sizer.count(p) for p in buf)
-                else:
-                    buf, buf_tokens = [], 0 # Reset buffer
-            buf.append(para) # Add paragraph to buffer
-            buf_tokens += t # Update token count
-        if buf: # Add any remaining paragraphs as a final chunk
-            chunk_text = "\n\n".join(buf)
-            chunks.append({"url": d["url"], "title": d.get("title", ""), "text": chunk_text})
-    return chunks
\ No newline at end of file
+    def emit(buf): # Join paragraphs with double newlines; pos: the chunk's place on its page
+        chunks.append({"url": d["url"], "title": d.get("title", ""), "text": "\n\n".join(text for text, _ in buf), "pos": len(chunks)})
+
+    buf, buf_tokens = [], 0
+    for text, toks in pieces:
+        t = len(toks)
+        if buf_tokens + t > target_tokens and buf: # If adding this piece exceeds target and buffer is not empty
+            emit(buf)
+            # Start new buffer with (up to) the last overlap_tokens tokens of the chunk just emitted, as many as fit next to this piece
+            last = buf[-1][1]
+            start = max(0, len(last) - min(overlap_tokens, target_tokens - t))
+            while start < len(last) and not sizer.is_boundary(last, start):
+                start += 1
+            tail = last[start:] if start < len(last) else []
+            buf = [(sizer.decode(tail), tail)] if tail else []
+            buf_tokens = sum(len(tk) for _, tk in buf) # known counts, no re-tokenizing
+        buf.append((text, toks)) # Add piece to buffer
+        buf_tokens += t # Update token count
+    if buf: # Add any remaining pieces as a final chunk
+        emit(buf)
+    return chunks
+
+# Chunk a stream of documents lazily. With workers > 0 documents are chunked on a process pool,
+# keeping at most a few documents per worker in flight so memory stays flat; output order is preserved.
+def chunk_docs(docs: Iterable[Dict], target_tokens=800, overlap_tokens=120, workers: int = 0) -> Iterator[Dict]:
+    if workers <= 0:
+        for d in docs:
+            yield from chunk_doc(d, target_tokens, overlap_tokens)
+        return
+    start = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn" # ingest may run threads (metrics server)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start)) as pool:
+        pending = deque()
+        for d in docs:
+            pending.append(pool.submit(chunk_doc, d, target_tokens, overlap_tokens))
+            if len(pending) >= workers * 4:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
@@ -14,6 +14,9 @@ class Settings(BaseModel):
     retriever: dict
     llm: dict
     ui: dict
+    answer_cache: dict = {} # optional section
+    metrics: dict = {} # optional section
+    serve: dict = {} # optional section
 
 
     @staticmethod
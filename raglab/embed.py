@@ -1,14 +1,220 @@
 # Class for generating embeddings using a specified model
 
+import os, hashlib, json, shutil, sqlite3, tempfile, threading
+from collections import OrderedDict
+from pathlib import Path
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from typing import List
+from typing import TYPE_CHECKING, Dict, List
+from . import metrics
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 
 class Embedder:
-    # Initialize the embedder with a specified model and batch size
+    # Initialize the embedder with a specified model and batch size (the model is loaded on first use)
     def __init__(self, model_name: str, batch_size: int = 64):
-        self.model = SentenceTransformer(model_name)
+        self.model_name = model_name
+        self.variant = model_name # identifies the vectors this embedder produces (cache keys, manifest)
         self.batch_size = batch_size
+        self._model = None
+
+    @property
+    def model(self) -> "SentenceTransformer":
+        if self._model is None:
+            from sentence_transformers import SentenceTransformer # imported on first use: pulls in torch
+            self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    # Load the model and run one tiny batch, so the first real query doesn't pay for lazy initialization
+    def warm_up(self) -> np.ndarray:
+        return self.encode(["warm-up"])
+
     # Encode a list of texts into embeddings
     def encode(self, texts: List[str]) -> np.array:
-        return np.asarray(self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True))
\ No newline at end of file
+        metrics.observe("embed_batch_size", len(texts))
+        with metrics.span("embed_encode"):
+            return np.asarray(self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True))
+
+# ONNX Runtime backend for CPU serving: same normalized-output contract as Embedder.encode, without importing torch.
+# The model is exported once into onnx_dir (needs optimum and transformers), optionally with dynamically quantized
+# int8 weights; serving only needs onnxruntime and tokenizers. threads=0 lets ONNX Runtime use every core.
+class OnnxEmbedder:
+    def __init__(self, model_name: str, batch_size: int = 64, onnx_dir: str = "index/onnx", quantize: bool = True, threads: int = 0):
+        self.model_name = model_name
+        self.variant = f"{model_name}:onnx{'-int8' if quantize else ''}" # int8 vectors differ slightly from torch ones
+        self.batch_size = batch_size
+        self.quantize = quantize
+        self.threads = threads
+        self.dir = Path(onnx_dir) / model_name.replace("/", "__")
+        self._session = self._tokenizer = None
+        self._lock = threading.Lock() # first use may come from several Streamlit threads at once
+
+    # Export model, tokenizer and pooling settings (once per model; the int8 file is added next to the fp32 one).
+    # Everything is written under a temporary name and renamed into place, so a reader never sees a partial file and
+    # concurrent exports (several processes starting at once) leave one complete copy.
+    @staticmethod
+    def export(model_name: str, out_dir: Path, quantize: bool):
+        out_dir = Path(out_dir)
+        if not (out_dir / "raglab_onnx.json").exists():
+            from optimum.onnxruntime import ORTModelForFeatureExtraction
+            from transformers import AutoTokenizer
+            out_dir.parent.mkdir(parents=True, exist_ok=True)
+            tmp = Path(tempfile.mkdtemp(prefix=out_dir.name + ".", dir=out_dir.parent))
+            ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(tmp)
+            AutoTokenizer.from_pretrained(model_name).save_pretrained(tmp) # writes tokenizer.json
+            pooling = json.loads(Path(_model_file(model_name, "1_Pooling/config.json")).read_text(encoding="utf-8"))
+            st_cfg = json.loads(Path(_model_file(model_name, "sentence_bert_config.json")).read_text(encoding="utf-8"))
+            settings = {"pooling": "cls" if pooling.get("pooling_mode_cls_token") else "mean", "max_length": st_cfg.get("max_seq_length", 512)}
+            (tmp / "raglab_onnx.json").write_text(json.dumps(settings), encoding="utf-8") # written last: marks a complete export
+            try:
+                os.replace(tmp, out_dir)
+            except OSError: # out_dir exists: another process's complete export, or leftovers of an older one that died
+                if (out_dir / "raglab_onnx.json").exists():
+                    shutil.rmtree(tmp, ignore_errors=True)
+                else:
+                    shutil.rmtree(out_dir, ignore_errors=True)
+                    os.replace(tmp, out_dir)
+        if quantize and not (out_dir / "model_int8.onnx").exists():
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            fd, tmp = tempfile.mkstemp(prefix="model_int8.", suffix=".onnx", dir=out_dir)
+            os.close(fd)
+            quantize_dynamic(str(out_dir / "model.onnx"), tmp, weight_type=QuantType.QInt8)
+            os.replace(tmp, out_dir / "model_int8.onnx")
+
+    def _load(self):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+        OnnxEmbedder.export(self.model_name, self.dir, self.quantize)
+        self.settings = json.loads((self.dir / "raglab_onnx.json").read_text(encoding="utf-8"))
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self._session = ort.InferenceSession(str(self.dir / ("model_int8.onnx" if self.quantize else "model.onnx")), options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self._session.get_inputs()}
+        self._tokenizer = Tokenizer.from_file(str(self.dir / "tokenizer.json"))
+        self._tokenizer.enable_truncation(max_length=self.settings["max_length"])
+        self._tokenizer.enable_padding() # pad to the longest text of each batch
+
+    def warm_up(self) -> np.ndarray:
+        return self.encode(["warm-up"])
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._load()
+        metrics.observe("embed_batch_size", len(texts))
+        out = []
+        with metrics.span("embed_encode"):
+            for i in range(0, len(texts), self.batch_size):
+                enc = self._tokenizer.encode_batch(texts[i:i + self.batch_size])
+                mask = np.array([e.attention_mask for e in enc], dtype=np.int64)
+                feed = {"input_ids": np.array([e.ids for e in enc], dtype=np.int64), "attention_mask": mask,
+                        "token_type_ids": np.array([e.type_ids for e in enc], dtype=np.int64)}
+                hidden = self._session.run(None, {k: v for k, v in feed.items() if k in self.input_names})[0] # (B, T, d) last hidden state
+                if self.settings["pooling"] == "cls":
+                    pooled = hidden[:, 0]
+                else: # mean over real tokens, like sentence-transformers' Pooling module
+                    pooled = (hidden * mask[:, :, None]).sum(axis=1) / np.maximum(mask.sum(axis=1, keepdims=True), 1)
+                out.append(pooled / np.linalg.norm(pooled, axis=1, keepdims=True))
+        return np.concatenate(out).astype(np.float32) if out else np.zeros((0, 0), dtype=np.float32)
+
+# A file of a sentence-transformers model, from a local directory or the Hugging Face hub
+def _model_file(model_name: str, filename: str) -> str:
+    if Path(model_name).is_dir():
+        return str(Path(model_name) / filename)
+    from huggingface_hub import hf_hub_download
+    return hf_hub_download(model_name, filename)
+
+# Embedder for the `embeddings:` section of the config (backend: torch | onnx)
+def make_embedder(emb_cfg: Dict) -> "Embedder | OnnxEmbedder":
+    backend = emb_cfg.get("backend", "torch")
+    if backend == "onnx":
+        return OnnxEmbedder(emb_cfg["model_name"], emb_cfg["batch_size"], emb_cfg.get("onnx_dir", "index/onnx"),
+                            emb_cfg.get("quantize", True), emb_cfg.get("threads", 0))
+    if backend != "torch":
+        raise ValueError(f"Unsupported embedding backend: {backend}")
+    return Embedder(emb_cfg["model_name"], emb_cfg["batch_size"])
+
+# Embedding cache in front of an Embedder: bounded in-memory LRU plus an optional SQLite tier that survives restarts.
+# Keys are the model name plus the whitespace-normalized text, so the output contract of Embedder.encode is unchanged.
+class CachedEmbedder:
+    def __init__(self, embedder: "Embedder | OnnxEmbedder", max_items: int = 4096, path: str | None = None):
+        self.embedder = embedder
+        self.model_name = embedder.model_name
+        self.variant = embedder.variant
+        self.max_items = max_items
+        self.lru: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.lock = threading.Lock() # Streamlit serves sessions from several threads
+        self.hits = self.disk_hits = self.misses = 0
+        self.db = None
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL") # readers in other processes don't block writers
+            self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB)")
+
+    # Create a (cached) embedder from the `embeddings:` section of the config
+    @staticmethod
+    def from_config(emb_cfg: Dict) -> "CachedEmbedder":
+        embedder = make_embedder(emb_cfg)
+        return CachedEmbedder(embedder, emb_cfg.get("cache_size", 4096), emb_cfg.get("cache_path"))
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.variant}\0{' '.join(text.split())}".encode("utf-8")).hexdigest()
+
+    # Same contract as Embedder.encode; only texts missing from both tiers reach the model, in one batch
+    def encode(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return self.embedder.encode(texts)
+        keys = [self.key(t) for t in texts]
+        found: Dict[str, np.ndarray] = {}
+        with self.lock:
+            for k in keys:
+                if k in self.lru:
+                    self.lru.move_to_end(k)
+                    found[k] = self.lru[k]
+            n = sum(k in found for k in keys)
+            self.hits += n
+            metrics.inc("embed_cache_hits_total", n)
+            wanted = list(dict.fromkeys(k for k in keys if k not in found))
+            if wanted and self.db is not None:
+                for i in range(0, len(wanted), 500): # stay under SQLite's bound-parameter limit
+                    part = wanted[i:i + 500]
+                    rows = self.db.execute(f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part).fetchall()
+                    for k, blob in rows:
+                        found[k] = np.frombuffer(blob, dtype=np.float32)
+                        self._remember(k, found[k])
+                n = sum(k in found for k in wanted)
+                self.disk_hits += n
+                metrics.inc("embed_cache_disk_hits_total", n)
+        missing = [k for k in dict.fromkeys(keys) if k not in found]
+        if missing:
+            first = {k: t for k, t in zip(keys, texts)} # one text per distinct key
+            X = np.asarray(self.embedder.encode([first[k] for k in missing]), dtype=np.float32)
+            with self.lock:
+                self.misses += len(missing)
+                metrics.inc("embed_cache_misses_total", len(missing))
+                for k, v in zip(missing, X):
+                    found[k] = v
+                    self._remember(k, v)
+                if self.db is not None:
+                    self.db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?)", [(k, v.tobytes()) for k, v in zip(missing, X)])
+                    self.db.commit()
+        return np.stack([found[k] for k in keys])
+
+    # Bypasses the cache: a cached warm-up text would never load the model
+    def warm_up(self) -> np.ndarray:
+        return self.embedder.warm_up()
+
+    def _remember(self, k: str, v: np.ndarray):
+        if self.max_items <= 0:
+            return
+        self.lru[k] = v
+        self.lru.move_to_end(k)
+        while len(self.lru) > self.max_items: # evict least recently used
+            self.lru.popitem(last=False)
+
+    # Hit/miss counters (hits: memory, disk_hits: SQLite, misses: texts sent to the model)
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "size": len(self.lru)}
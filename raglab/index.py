@@ -1,40 +1,206 @@
 # Class for managing a FAISS index with metadata
 
-import json, os
+import json, os, shutil
 from pathlib import Path
 import numpy as np
 import faiss
 from typing import List, Dict
+from .metastore import MetaStore, write_metastore
+from . import metrics
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+# Default build/search parameters, overridden by the `index:` section of the config
+DEFAULT_PARAMS = {
+    "nlist": 1024, # IVF: number of inverted lists (clamped for small corpora)
+    "nprobe": 16, # IVF: lists visited per query
+    "hnsw_m": 32, # HNSW: graph neighbours per node
+    "ef_construction": 200, # HNSW: candidate list size while building
+    "ef_search": 64, # HNSW: candidate list size while searching
+    "pq_m": 48, # IVF-PQ: sub-quantizers, code size is pq_m * pq_nbits / 8 bytes per vector
+    "pq_nbits": 8, # IVF-PQ: bits per sub-quantizer code
+}
+
+# Build (and train if needed) a FAISS inner-product index of the requested type, vectors are added under `ids`
+def create_index(embeddings: np.ndarray, index_type: str = "flat", params: Dict | None = None, ids: np.ndarray | None = None) -> faiss.Index:
+    p = {**DEFAULT_PARAMS, **(params or {})}
+    n, dim = embeddings.shape
+    if index_type == "flat":
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim)) # Exhaustive scan, exact results; ID map allows add/remove by id
+    elif index_type == "hnsw":
+        base = faiss.IndexHNSWFlat(dim, p["hnsw_m"], faiss.METRIC_INNER_PRODUCT) # Graph index, no training
+        base.hnsw.efConstruction = p["ef_construction"]
+        index = faiss.IndexIDMap2(base)
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        nlist = max(1, min(p["nlist"], n // 39)) # FAISS wants ~39 training points per centroid
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            if dim % p["pq_m"]:
+                raise ValueError(f"pq_m={p['pq_m']} must divide the embedding dimension {dim}")
+            nbits = max(1, min(p["pq_nbits"], int(np.log2(max(n, 2))))) # k-means needs at least 2**nbits points
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, p["pq_m"], nbits, faiss.METRIC_INNER_PRODUCT)
+        index.train(embeddings) # Train centroids (and PQ codebooks) on the corpus itself
+    else:
+        raise ValueError(f"Unsupported index type: {index_type} (expected one of {INDEX_TYPES})")
+    index.add_with_ids(embeddings, np.arange(n, dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)) # IVF indexes store ids natively
+    set_search_params(index, p)
+    return index
+
+# Unwrap an ID map to reach the index that holds the search knobs
+def _base(index: faiss.Index) -> faiss.Index:
+    return faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+
+# Apply query-time knobs (nprobe / efSearch), they are not fixed at build time
+def set_search_params(index: faiss.Index, params: Dict):
+    base = _base(index)
+    if isinstance(base, faiss.IndexIVF) and "nprobe" in params:
+        base.nprobe = params["nprobe"]
+    if isinstance(base, faiss.IndexHNSW) and "ef_search" in params:
+        base.hnsw.efSearch = params["ef_search"]
+
+# Whether ids can be added and removed in place (HNSW graphs and pre-ID-map indexes must be rebuilt)
+def supports_update(index: faiss.Index) -> bool:
+    return isinstance(index, faiss.IndexIVF) or (isinstance(index, faiss.IndexIDMap) and not isinstance(_base(index), faiss.IndexHNSW))
+
+# File names inside a serving snapshot, by the `index:` config key they replace
+SNAPSHOT_FILES = {"faiss_path": "faiss.index", "meta_path": "meta.bin", "vectors_path": "vectors.npy", "lexical_path": "bm25.npz"}
+
+# The `index:` section to serve from: paths point into the snapshot (memory-mapped) once `ingest.py --snapshot` has written one
+def serving_config(index_cfg: Dict) -> Dict:
+    snap = index_cfg.get("snapshot_dir")
+    if not snap or not (Path(snap) / SNAPSHOT_FILES["faiss_path"]).exists():
+        return index_cfg
+    return {**index_cfg, **{k: str(Path(snap) / name) for k, name in SNAPSHOT_FILES.items()}, "mmap": True}
+
+# Swap a freshly written directory in place of `directory` (two renames, the old copy is removed afterwards)
+def replace_dir(tmp: Path, directory: Path):
+    old = directory.with_name(directory.name + ".old")
+    shutil.rmtree(old, ignore_errors=True)
+    if directory.exists():
+        directory.rename(old)
+    tmp.rename(directory)
+    shutil.rmtree(old, ignore_errors=True)
 
 class FaissIndex:
-    def __init__(self, index_path: str, meta_path: str):
+    def __init__(self, index_path: str, meta_path: str, vectors_path: str | None = None, index_type: str = "flat", params: Dict | None = None, mmap: bool = False):
+        self.mmap = mmap # Memory-map the FAISS index read-only (serving), instead of reading it into memory
         self.index_path, self.meta_path = Path(index_path), Path(meta_path) # Paths for index and metadata
+        self.vectors_path = Path(vectors_path) if vectors_path else self.index_path.with_suffix(".npy") # Sidecar with chunk embeddings
+        self.info_path = self.index_path.with_name(self.index_path.name + ".json") # Index type and parameters, saved next to the index
+        self.index_type = index_type
+        self.params = params or {}
         self.index = None # FAISS index
-        self.meta: list[Dict] = [] # List to hold metadata for each vector
-
-    # Build the FAISS index from embeddings and associated metadata
-    def build (self, embeddings: np.ndarray, meta: List[Dict]):
-        dim = embeddings.shape[1] # Dimension of embeddings
-        self.index = faiss.IndexFlatIP(dim) # Create FAISS index for inner product
-        self.index.add(embeddings.astype('float32')) # Add embeddings to index
-        self.meta = meta # Store metadata
-    
-    # Save the FAISS index and metadata to disk
+        self.meta: list[Dict] | MetaStore = [] # Metadata for each vector (memory-mapped store once loaded)
+        self.vectors: np.ndarray | None = None # Chunk embeddings, row i matches meta[i]
+        self.ids: np.ndarray | None = None # Sorted chunk ids, row i of meta/vectors holds chunk ids[i]
+
+    # Create an index from the `index:` section of the config
+    @staticmethod
+    def from_config(index_cfg: Dict) -> "FaissIndex":
+        params = {k: v for k, v in index_cfg.items() if k in DEFAULT_PARAMS}
+        return FaissIndex(index_cfg["faiss_path"], index_cfg["meta_path"], index_cfg.get("vectors_path"), index_cfg.get("type", "flat"), params, index_cfg.get("mmap", False))
+
+    # Build the FAISS index from embeddings and associated metadata (chunk ids default to row numbers)
+    def build (self, embeddings: np.ndarray, meta: List[Dict], ids: np.ndarray | None = None):
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        ids = np.arange(len(meta), dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+        order = np.argsort(ids, kind="stable") # Rows are kept sorted by id so labels map to rows by binary search
+        self.ids, self.vectors, self.meta = ids[order], embeddings[order], [meta[i] for i in order] # Keep vectors so MMR never has to re-encode documents
+        self.index = create_index(self.vectors, self.index_type, self.params, self.ids) # Create (and train) FAISS index for inner product
+
+    # Add new chunks and drop removed ones by id, without touching unchanged vectors
+    def update(self, embeddings: np.ndarray, meta: List[Dict], ids: np.ndarray, remove_ids=()):
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32').reshape(len(meta), self.vectors.shape[1])
+        ids, remove_ids = np.asarray(ids, dtype=np.int64), np.asarray(remove_ids, dtype=np.int64)
+        keep = np.flatnonzero(~np.isin(self.ids, remove_ids)) # Surviving rows
+        all_ids = np.concatenate([self.ids[keep], ids])
+        order = np.argsort(all_ids, kind="stable")
+        rows = [self.meta[i] for i in keep] + list(meta)
+        self.vectors = np.concatenate([np.asarray(self.vectors[keep], dtype='float32'), embeddings])[order]
+        self.ids, self.meta = all_ids[order], [rows[i] for i in order]
+        if supports_update(self.index): # Flat (ID map) and IVF indexes are edited in place
+            if len(remove_ids):
+                self.index.remove_ids(remove_ids)
+            if len(ids):
+                self.index.add_with_ids(embeddings, ids)
+        elif len(ids) or len(remove_ids): # HNSW cannot delete: rebuild from the stored vectors, no re-embedding needed
+            self.index = create_index(self.vectors, self.index_type, self.params, self.ids)
+
+    # Save the FAISS index, metadata and embeddings to disk
     def save(self):
         self.index_path.parent.mkdir(parents=True, exist_ok=True) # Ensure directory exists
         faiss.write_index(self.index, str(self.index_path)) # Save FAISS index
-        with open(self.meta_path, "w", encoding="utf-8") as f: # Save metadata as JSON
-            for m in self.meta:
-                f.write(json.dumps(m, ensure_ascii=False) + "\n")
+        info = {"type": self.index_type, "dim": self.index.d, "ntotal": self.index.ntotal, "params": {**DEFAULT_PARAMS, **self.params}}
+        self.info_path.write_text(json.dumps(info, indent=2), encoding="utf-8")
+        if self.meta_path.suffix == ".jsonl": # Legacy JSON lines metadata
+            with open(self.meta_path, "w", encoding="utf-8") as f:
+                for m in self.meta:
+                    f.write(json.dumps(m, ensure_ascii=False) + "\n")
+        else: # Compact binary store, memory-mapped on load
+            write_metastore(self.meta_path, self.meta, self.ids)
+        tmp = self.vectors_path.with_name(self.vectors_path.name + ".tmp")
+        with open(tmp, "wb") as f: # Write to a temp file so a memory-mapped copy is never truncated under a reader
+            np.save(f, np.asarray(self.vectors, dtype='float32'))
+        os.replace(tmp, self.vectors_path)
 
-    # Load the FAISS index and metadata from disk    
+    # Write a read-only copy for serving (binary metadata, index loaded with mmap) and swap it in as one directory.
+    # extra maps snapshot file names to files copied along (e.g. the BM25 index). Readers of the previous snapshot
+    # keep their open files; new readers see either the old or the new snapshot, never a mix.
+    def save_snapshot(self, directory: str, extra: Dict[str, str] | None = None):
+        directory = Path(directory)
+        tmp = directory.with_name(directory.name + ".tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        snap = FaissIndex(tmp / SNAPSHOT_FILES["faiss_path"], tmp / SNAPSHOT_FILES["meta_path"], tmp / SNAPSHOT_FILES["vectors_path"], self.index_type, self.params)
+        snap.index, snap.meta, snap.vectors, snap.ids = self.index, self.meta, self.vectors, self.ids
+        snap.save()
+        for name, src in (extra or {}).items():
+            shutil.copyfile(src, tmp / name)
+        replace_dir(tmp, directory)
+
+    # Load the FAISS index and metadata from disk
     def load(self):
-        self.index = faiss.read_index(str(self.index_path)) # Load FAISS index
-        self.meta = [json.loads(line) for line in open(self.meta_path, "r", encoding="utf-8")] # Load metadata
-    
-    # Search the index with a query vector and return top_k results with metadata
-    def search(self, query_vec: np.ndarray, top_k: int) -> tuple[np.ndarray, List[Dict]]:
-        D, I = self.index.search(query_vec.astype('float32'), top_k) # Search index
-        selected = [self.meta[i] for i in I[0]] # Retrieve metadata for top results
-        return D, selected # Return distances and metadata of top results
-            
\ No newline at end of file
+        self.index = faiss.read_index(str(self.index_path), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if self.mmap else 0) # Load FAISS index
+        if self.info_path.exists(): # The saved type wins over the config, search knobs from the config win over the saved ones
+            info = json.loads(self.info_path.read_text(encoding="utf-8"))
+            self.index_type = info["type"]
+            self.params = {**info.get("params", {}), **self.params}
+        set_search_params(self.index, self.params)
+        if self.meta_path.suffix == ".jsonl": # Legacy JSON lines metadata, parsed into memory
+            self.meta = [json.loads(line) for line in open(self.meta_path, "r", encoding="utf-8")]
+            self.ids = np.arange(len(self.meta), dtype=np.int64)
+        else: # Only the header is read, rows are decoded on demand
+            self.meta = MetaStore(self.meta_path)
+            self.ids = self.meta.ids
+        if self.vectors_path.exists(): # Memory-map the embeddings, pages are shared between processes
+            self.vectors = np.load(self.vectors_path, mmap_mode="r")
+        else: # Older index without sidecar: recover vectors from the flat index
+            self.vectors = self.index.reconstruct_n(0, self.index.ntotal)
+
+    # Metadata (and stored embeddings) of chunks by id, e.g. for hits that came from another index
+    def lookup(self, ids, return_vectors: bool = False):
+        rows = np.searchsorted(self.ids, ids)
+        docs = [{"id": int(i), **self.meta[r]} for i, r in zip(ids, rows)]
+        return (docs, np.asarray(self.vectors[rows])) if return_vectors else docs
+
+    # Search the index with a query vector and return top_k results with metadata (and their embeddings if asked)
+    def search(self, query_vec: np.ndarray, top_k: int, return_vectors: bool = False):
+        return self.search_batch(np.asarray(query_vec).reshape(1, -1), top_k, return_vectors)[0]
+
+    # Search many query vectors (Q, d) in one FAISS call; returns one (scores, docs[, vectors]) tuple per query
+    def search_batch(self, query_vecs: np.ndarray, top_k: int, return_vectors: bool = False) -> list[tuple]:
+        with metrics.span("index_search"):
+            D, I = self.index.search(np.ascontiguousarray(query_vecs, dtype='float32'), top_k) # Search index, FAISS parallelizes over queries
+        results = []
+        for d, labels in zip(D, I):
+            keep = labels >= 0 # FAISS pads with -1 when the index holds fewer than top_k vectors
+            labels, scores = labels[keep], d[keep]
+            metrics.observe("index_candidates", len(labels))
+            rows = np.searchsorted(self.ids, labels) # FAISS returns chunk ids, map them to rows
+            selected = [{"id": int(l), **self.meta[r]} for l, r in zip(labels, rows)] # Retrieve metadata for top results
+            if return_vectors:
+                results.append((scores, selected, np.asarray(self.vectors[rows]))) # Stored embeddings of the candidates
+            else:
+                results.append((scores, selected)) # Return distances and metadata of top results
+        return results
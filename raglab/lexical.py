@@ -0,0 +1,100 @@
+# Sparse BM25 index over the chunk texts, stored next to the FAISS index and keyed by the same chunk ids
+
+import re
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Tuple
+import numpy as np
+
+if TYPE_CHECKING:
+    import scipy.sparse as sp
+
+# scipy.sparse is imported inside the methods that need it: dense-only serving never loads it
+
+TOKEN_RE = re.compile(r"[a-z0-9_]+(?:\.[a-z0-9_]+)*") # keeps dotted API names (functools.lru_cache) in one piece
+
+# Lowercase word tokens; a dotted name also counts as each of its parts, so "lru_cache" finds "functools.lru_cache"
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for tok in TOKEN_RE.findall(text.lower()):
+        tokens.append(tok)
+        if "." in tok:
+            tokens.extend(tok.split("."))
+    return tokens
+
+# Reciprocal-rank fusion of several ranked id lists: score(id) = sum over lists of 1 / (k + rank); returns (id, score) best first
+def rrf(rankings: List[List[int]], k: int = 60) -> List[Tuple[int, float]]:
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, i in enumerate(ranking, 1):
+            scores[i] = scores.get(i, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+class LexicalIndex:
+    # weights: (n_docs, n_terms) CSR matrix of per-document BM25 term weights, so a query score is a sparse dot product
+    def __init__(self, weights: "sp.csr_matrix", vocab: Dict[str, int], ids: np.ndarray):
+        self.weights = weights
+        self.vocab = vocab
+        self.ids = ids
+
+    # Build from chunk texts (ids are the FAISS chunk ids, row i belongs to ids[i])
+    @staticmethod
+    def build(texts, ids, k1: float = 1.2, b: float = 0.75) -> "LexicalIndex":
+        import scipy.sparse as sp
+        vocab: Dict[str, int] = {}
+        cols, indptr = [], [0]
+        for text in texts:
+            cols.extend(vocab.setdefault(t, len(vocab)) for t in tokenize(text))
+            indptr.append(len(cols))
+        n = len(indptr) - 1
+        counts = sp.csr_matrix((np.ones(len(cols), dtype=np.float32), np.asarray(cols, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+                               shape=(n, len(vocab)))
+        counts.sum_duplicates() # term frequencies
+        doc_len = np.diff(np.asarray(indptr)).astype(np.float32)
+        df = np.bincount(counts.indices, minlength=len(vocab))
+        idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        tf = counts.data
+        norm = np.repeat(k1 * (1 - b + b * doc_len / max(doc_len.mean(), 1.0)), np.diff(counts.indptr)) # per nonzero, from its row
+        counts.data = idf[counts.indices] * tf * (k1 + 1) / (tf + norm)
+        return LexicalIndex(counts, vocab, np.asarray(ids, dtype=np.int64))
+
+    # One .npz: the CSR arrays, chunk ids and the vocabulary as a newline-joined blob (terms never contain newlines)
+    def save(self, path: str):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        terms = sorted(self.vocab, key=self.vocab.get)
+        tmp = path.with_name(path.name + ".tmp.npz")
+        np.savez(tmp, data=self.weights.data.astype(np.float32), indices=self.weights.indices.astype(np.int32),
+                 indptr=self.weights.indptr.astype(np.int64), shape=np.asarray(self.weights.shape, dtype=np.int64),
+                 ids=self.ids, terms=np.frombuffer("\n".join(terms).encode("utf-8"), dtype=np.uint8))
+        tmp.replace(path)
+
+    @staticmethod
+    def load(path: str) -> "LexicalIndex":
+        import scipy.sparse as sp
+        with np.load(path) as z:
+            weights = sp.csr_matrix((z["data"], z["indices"], z["indptr"]), shape=tuple(z["shape"]))
+            blob = z["terms"].tobytes().decode("utf-8")
+            ids = z["ids"]
+        terms = blob.split("\n") if blob else []
+        return LexicalIndex(weights, {t: i for i, t in enumerate(terms)}, ids)
+
+    # Score many queries with one sparse product; returns one (scores, chunk ids) pair per query, best first.
+    # Only documents sharing a term with the query are returned, so a row may be shorter than top_k (or empty).
+    def search_batch(self, queries: List[str], top_k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        import scipy.sparse as sp
+        rows, cols = [], []
+        for i, q in enumerate(queries):
+            terms = {self.vocab[t] for t in tokenize(q) if t in self.vocab} # unknown terms can't match anything
+            rows.extend([i] * len(terms))
+            cols.extend(terms)
+        query_terms = sp.csr_matrix((np.ones(len(cols), dtype=np.float32), (rows, cols)), shape=(len(queries), self.weights.shape[1]))
+        scores = (query_terms @ self.weights.T).tocsr() # (Q, n_docs), nonzero only where a query term occurs
+        results = []
+        for i in range(len(queries)):
+            s, docs = scores.data[scores.indptr[i]:scores.indptr[i + 1]], scores.indices[scores.indptr[i]:scores.indptr[i + 1]]
+            if len(s) > top_k:
+                top = np.argpartition(-s, top_k - 1)[:top_k]
+                s, docs = s[top], docs[top]
+            order = np.argsort(-s, kind="stable")
+            results.append((s[order], self.ids[docs[order]]))
+        return results
@@ -1,44 +1,145 @@
 # LLM interface for different providers
 
-import os, requests
-from typing import Optional
-from openai import OpenAI
+import os, sys, json, time, random, asyncio, threading, requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, TypeVar
+from requests.adapters import HTTPAdapter
+from . import metrics
 
+T = TypeVar("T")
+
+RETRY_STATUS = {408, 429, 500, 502, 503, 504} # HTTP statuses worth retrying
+
+# Transient failures: connection problems, timeouts, rate limits and server errors (never bad requests)
+def is_transient(exc: Exception) -> bool:
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is not None and exc.response.status_code in RETRY_STATUS
+    openai = sys.modules.get("openai") # never imported on the Ollama path, so nothing can be an openai error
+    return openai is not None and isinstance(exc, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError))
+
+# One client per LLM instance: a pooled HTTP connection per provider, at most `max_concurrency` requests in flight
+# (extra callers block until a slot frees up) and up to `max_retries` retries of transient errors with jittered backoff.
 class LLM:
-    def __init__(self, provider: str, model: str, temperature=0.2, max_tokens=512, timeout_sec=60):
+    def __init__(self, provider: str, model: str, temperature=0.2, max_tokens=512, timeout_sec=60,
+                 max_concurrency=4, max_retries=3, retry_backoff_sec=0.5):
         self.provider = provider
         self.model = model
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.timeout_sec = timeout_sec
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.retry_backoff_sec = retry_backoff_sec
+        self.slots = threading.BoundedSemaphore(self.max_concurrency) # backpressure across threads and asyncio tasks
+        self.session = None
         if provider == "openai":
-            self.client = OpenAI()
+            from openai import OpenAI # imported on demand: the SDK takes most of a second to import
+            self.client = OpenAI(timeout=timeout_sec, max_retries=0) # retries are ours; the client pools its connections
         else:
             self.client = None # Placeholder for other providers
+            self.session = requests.Session() # keep-alive connections to the Ollama host
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+
+    # Call fn, retrying transient errors with exponential backoff and full jitter
+    def _with_retries(self, fn: Callable[[], T]) -> T:
+        for attempt in range(self.max_retries + 1):
+            try:
+                return fn()
+            except Exception as exc:
+                if attempt == self.max_retries or not is_transient(exc):
+                    metrics.inc("llm_errors_total")
+                    raise
+                metrics.inc("llm_retries_total")
+                time.sleep(random.uniform(0, self.retry_backoff_sec * 2 ** attempt))
+
+    # Ollama /api/generate request (max_tokens maps to num_predict)
+    def _ollama_request(self, prompt: str, stream: bool) -> requests.Response:
+        host = os.getenv("OLLAMA_HOST", "http://localhost:11434") # default host
+        response = self.session.post( # POST request to Ollama
+            f"{host}/api/generate", # endpoint
+            json={  # request body
+                "model": self.model,
+                "prompt": prompt,
+                "stream": stream,
+                "options": {"temperature": self.temperature, "num_predict": self.max_tokens}},
+            timeout=self.timeout_sec, # timeout (connect and between streamed chunks)
+            stream=stream,
+        )
+        try:
+            response.raise_for_status() # raise error for bad status
+        except requests.HTTPError:
+            response.close() # give the connection back to the pool
+            raise
+        return response
+
+    # Load the model before the first question arrives (Ollama loads a model on a request without a prompt)
+    def warm_up(self):
+        if self.provider == "ollama":
+            host = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+            self.session.post(f"{host}/api/generate", json={"model": self.model, "stream": False}, timeout=self.timeout_sec).raise_for_status()
+
+    def _openai_request(self, prompt: str, stream: bool):
+        return self.client.chat.completions.create( # chat completion
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            stream=stream,
+        )
 
     # Generate text based on the prompt
     def generate(self, prompt: str) -> str:
-        if self.provider == "ollama": # Ollama API call
-            host = os.getenv("OLLAMA_HOST", "http://localhost:11434") # default host
-            response = requests.post( # POST request to Ollama
-                f"{host}/api/generate", # endpoint
-                json={  # request body
-                    "model": self.model,
-                    "prompt": prompt,
-                    "stream": False,
-                    "options": {"temperature": self.temperature}},
-                timeout=self.timeout_sec, # timeout
-            )
-            response.raise_for_status() # raise error for bad status
-            return response.json().get("response", "") # return response text
-        elif self.provider == "openai": # OpenAI API call
-            response = self.client.chat.completions.create( # chat completion
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-            )
-            return response.choices[0].message.content # return response text
+        with self.slots, metrics.span("llm_generate"):
+            if self.provider == "ollama": # Ollama API call
+                return self._with_retries(lambda: self._ollama_request(prompt, stream=False).json().get("response", "")) # return response text
+            elif self.provider == "openai": # OpenAI API call
+                return self._with_retries(lambda: self._openai_request(prompt, stream=False)).choices[0].message.content # return response text
+            else:
+                raise ValueError(f"Unsupported provider: {self.provider}")
+
+    # Generate answers for many prompts with up to max_concurrency requests in flight; results keep the prompts' order
+    def generate_many(self, prompts: List[str]) -> List[str]:
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            return list(pool.map(self.generate, prompts))
+
+    # Async variants: the blocking call runs on a worker thread, under the same in-flight limit
+    async def agenerate(self, prompt: str) -> str:
+        return await asyncio.to_thread(self.generate, prompt)
+
+    async def agenerate_many(self, prompts: List[str]) -> List[str]:
+        return list(await asyncio.gather(*(self.agenerate(p) for p in prompts)))
+
+    # Generate text based on the prompt, yielding pieces of the answer as soon as the provider sends them.
+    # Only opening the stream is retried: once tokens have been yielded a retry would repeat them.
+    def generate_stream(self, prompt: str) -> Iterator[str]:
+        t0, first = time.perf_counter(), True
+        with self.slots, metrics.span("llm_generate"): # the slot is held until the stream is finished or closed
+            for piece in self._stream(prompt):
+                if first:
+                    metrics.observe("llm_first_token_seconds", time.perf_counter() - t0)
+                    first = False
+                yield piece
+
+    def _stream(self, prompt: str) -> Iterator[str]:
+        if self.provider == "ollama": # NDJSON: one JSON object per line, the last one has "done": true
+            with self._with_retries(lambda: self._ollama_request(prompt, stream=True)) as response:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    part = json.loads(line)
+                    if part.get("error"):
+                        raise RuntimeError(f"Ollama error: {part['error']}")
+                    if part.get("response"):
+                        yield part["response"]
+                    if part.get("done"):
+                        break
+        elif self.provider == "openai": # server-sent chunks with content deltas
+            for chunk in self._with_retries(lambda: self._openai_request(prompt, stream=True)):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
         else:
             raise ValueError(f"Unsupported provider: {self.provider}")
-                
\ No newline at end of file
@@ -0,0 +1,44 @@
+# Ingest manifest: what was indexed for each URL, so the next ingest only redoes what changed
+
+import json, hashlib, os
+from pathlib import Path
+from typing import Dict, List
+
+# Stable content hash for page and chunk texts
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class Manifest:
+    def __init__(self, path: str, settings: Dict | None = None):
+        self.path = Path(path)
+        self.settings = settings or {} # Settings the index depends on; any change forces a full rebuild
+        self.pages: Dict[str, Dict] = {} # url -> {"hash", "etag", "last_modified", "chunks": [[chunk_hash, id], ...]}
+        self.next_id = 0 # Next free chunk id
+
+    # Load the manifest if it exists and was written with the same settings, otherwise start empty
+    @staticmethod
+    def load(path: str, settings: Dict) -> "Manifest":
+        m = Manifest(path, settings)
+        if m.path.exists():
+            data = json.loads(m.path.read_text(encoding="utf-8"))
+            if data.get("settings") == settings:
+                m.pages, m.next_id = data["pages"], data["next_id"]
+        return m
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps({"settings": self.settings, "next_id": self.next_id, "pages": self.pages}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.path) # only replace the old manifest once the index it describes is saved
+
+    # ETag / Last-Modified per URL, for conditional GETs
+    def validators(self) -> Dict[str, Dict]:
+        return {url: {"etag": p.get("etag"), "last_modified": p.get("last_modified")} for url, p in self.pages.items()}
+
+    # Chunk ids of a page
+    def chunk_ids(self, url: str) -> List[int]:
+        return [cid for _, cid in self.pages.get(url, {}).get("chunks", [])]
+
+    def new_id(self) -> int:
+        self.next_id += 1
+        return self.next_id - 1
@@ -0,0 +1,124 @@
+# Compact, memory-mapped store for chunk metadata (url, title, text, pos)
+#
+# Layout (little-endian, sections 8-byte aligned):
+#   b"RAGMETA1" | u64 header length | JSON header | sections
+# The header maps each section name to its offset, dtype and length:
+#   text_off  u64[n+1]   byte offsets of each row's text in text_blob
+#   text_blob u8[...]    UTF-8 texts, back to back
+#   url_id    u32[n]     index into the interned string table
+#   title_id  u32[n]     index into the interned string table
+#   str_off   u64[m+1]   byte offsets of each interned string in str_blob
+#   str_blob  u8[...]    UTF-8 urls and titles, each stored once
+#   ids       i64[n]     chunk id of each row, sorted (optional, defaults to 0..n-1)
+#   pos       u32[n]     position of each chunk on its page (optional, older stores have none)
+# Opening a store only parses the header; rows are decoded on access, so startup
+# cost and private memory do not grow with the corpus and processes share pages.
+
+import json, mmap, os
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List
+import numpy as np
+
+MAGIC = b"RAGMETA1"
+
+# Write rows (dicts with url, title, text and pos) and their sorted chunk ids to path
+def write_metastore(path: str | Path, rows: Iterable[Dict], ids=None):
+    path = Path(path)
+    strings: dict[str, int] = {} # interned urls and titles
+    text_off, url_id, title_id, texts, pos = [0], [], [], [], []
+    for r in rows:
+        b = r.get("text", "").encode("utf-8")
+        texts.append(b)
+        text_off.append(text_off[-1] + len(b))
+        url_id.append(strings.setdefault(r.get("url", ""), len(strings)))
+        title_id.append(strings.setdefault(r.get("title", ""), len(strings)))
+        pos.append(r.get("pos"))
+    encoded = [s.encode("utf-8") for s in strings] # dict keeps insertion order == id order
+    sections = {
+        "text_off": np.asarray(text_off, dtype="<u8"),
+        "text_blob": np.frombuffer(b"".join(texts), dtype="u1"),
+        "url_id": np.asarray(url_id, dtype="<u4"),
+        "title_id": np.asarray(title_id, dtype="<u4"),
+        "str_off": np.cumsum([0] + [len(s) for s in encoded], dtype="<u8"),
+        "str_blob": np.frombuffer(b"".join(encoded), dtype="u1"),
+    }
+    if ids is not None:
+        sections["ids"] = np.asarray(ids, dtype="<i8")
+    if pos and None not in pos: # rows without positions (older metadata) round-trip without one
+        sections["pos"] = np.asarray(pos, dtype="<u4")
+    # Lay out sections after the header; the header size depends on the offsets, so iterate until stable
+    header_len = 0
+    while True:
+        offset, layout = _align(len(MAGIC) + 8 + header_len), {}
+        for name, arr in sections.items():
+            layout[name] = {"offset": offset, "dtype": arr.dtype.str, "count": int(arr.size)}
+            offset = _align(offset + arr.nbytes)
+        header = json.dumps({"rows": len(url_id), "sections": layout}).encode("utf-8")
+        if len(header) == header_len:
+            break
+        header_len = len(header)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f: # temp file + rename keeps existing readers' mappings valid
+        f.write(MAGIC + np.uint64(header_len).tobytes() + header)
+        for name, arr in sections.items():
+            f.seek(layout[name]["offset"])
+            f.write(arr.tobytes())
+        f.truncate(offset) # pad to the end of the last (possibly empty) section
+    os.replace(tmp, path)
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+# Read-only view over a metastore file, indexable like the old list of dicts
+class MetaStore:
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) # the mapping outlives the file handle
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path} is not a metadata store")
+        header_len = int(np.frombuffer(self._mm, dtype="<u8", count=1, offset=len(MAGIC))[0])
+        header = json.loads(self._mm[len(MAGIC) + 8:len(MAGIC) + 8 + header_len])
+        self._n = header["rows"]
+        self._pos = None # stores written before chunk positions existed
+        for name, s in header["sections"].items(): # zero-copy views into the mapping
+            setattr(self, "_" + name, np.frombuffer(self._mm, dtype=s["dtype"], count=s["count"], offset=s["offset"]))
+        if "ids" not in header["sections"]: # stores written before chunk ids existed
+            self._ids = np.arange(self._n, dtype=np.int64)
+        self._string = lru_cache(maxsize=4096)(self._decode_string) # urls/titles repeat across chunks of a page
+
+    def __len__(self) -> int:
+        return self._n
+
+    # Chunk id of each row, sorted ascending
+    @property
+    def ids(self) -> np.ndarray:
+        return self._ids
+
+    def __getitem__(self, i: int) -> Dict:
+        i = int(i)
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError(i)
+        s, e = self._text_off[i], self._text_off[i + 1]
+        row = {
+            "url": self._string(int(self._url_id[i])),
+            "title": self._string(int(self._title_id[i])),
+            "text": self._text_blob[s:e].tobytes().decode("utf-8"),
+        }
+        if self._pos is not None:
+            row["pos"] = int(self._pos[i])
+        return row
+
+    def __iter__(self) -> Iterator[Dict]:
+        return (self[i] for i in range(self._n))
+
+    # Decode only the selected rows
+    def take(self, ids: Iterable[int]) -> List[Dict]:
+        return [self[i] for i in ids]
+
+    def _decode_string(self, i: int) -> str:
+        return self._str_blob[self._str_off[i]:self._str_off[i + 1]].tobytes().decode("utf-8")
@@ -0,0 +1,202 @@
+# Lightweight instrumentation: timing spans, histograms, counters and gauges, exported as Prometheus text
+# (file and/or HTTP endpoint) and as a JSONL log with one line per traced request.
+# Disabled by default: span() then returns a shared no-op context manager and the other calls return immediately.
+
+import bisect, json, time, threading, contextvars
+from contextlib import contextmanager, nullcontext
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+PREFIX = "raglab_"
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # seconds
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192) # tokens, candidates, batch sizes
+
+_enabled = False
+_trace_path: Path | None = None
+_prom_path: Path | None = None
+_server = None
+_lock = threading.Lock()
+_hists: Dict[str, "Histogram"] = {}
+_counters: Dict[str, float] = {}
+_gauges: Dict[str, float] = {}
+_current: contextvars.ContextVar = contextvars.ContextVar("raglab_trace", default=None) # trace of the request being served
+_NOOP = nullcontext()
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last slot: above the largest bucket
+        self.sum, self.count = 0.0, 0
+
+    def observe(self, v: float):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+# Per-request record: spans in the order they finished, plus the values and counts observed while it was active
+class Trace:
+    def __init__(self, name: str):
+        self.name = name
+        self.spans: List[tuple] = [] # (name, seconds)
+        self.values: Dict[str, float] = {}
+        self.start = time.perf_counter()
+        self.seconds = 0.0
+
+    def to_dict(self) -> Dict:
+        seconds = self.seconds or time.perf_counter() - self.start # still running: time so far
+        return {"ts": time.time(), "name": self.name, "total_ms": round(seconds * 1000, 3),
+                "spans": [{"name": n, "ms": round(s * 1000, 3)} for n, s in self.spans], "values": self.values}
+
+# Throughput of a batch stage (crawl, chunk, embed, ...): set items while the stage runs
+class Stage:
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.seconds = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.items / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self) -> str:
+        return f"{self.name}: {self.items} in {self.seconds:.2f}s ({self.rate:.1f}/s)"
+
+# Turn instrumentation on or off (the `metrics:` section of the config); with a port, serve /metrics for Prometheus
+def configure(metrics_cfg: Dict):
+    global _enabled, _trace_path, _prom_path, _server
+    _enabled = bool(metrics_cfg.get("enabled", False))
+    _trace_path = Path(metrics_cfg["trace_path"]) if metrics_cfg.get("trace_path") else None
+    _prom_path = Path(metrics_cfg["prometheus_path"]) if metrics_cfg.get("prometheus_path") else None
+    for p in (_trace_path, _prom_path):
+        if p is not None:
+            p.parent.mkdir(parents=True, exist_ok=True)
+    if _enabled and metrics_cfg.get("prometheus_port") and _server is None:
+        _server = serve(metrics_cfg["prometheus_port"], metrics_cfg.get("prometheus_host", "127.0.0.1"))
+
+def enabled() -> bool:
+    return _enabled
+
+def _hist(name: str) -> Histogram:
+    h = _hists.get(name)
+    if h is None:
+        h = _hists[name] = Histogram(TIME_BUCKETS if name.endswith("_seconds") else COUNT_BUCKETS)
+    return h
+
+# Time a block: observed in the `<name>_seconds` histogram and added to the current trace
+def span(name: str):
+    return _span(name) if _enabled else _NOOP
+
+@contextmanager
+def _span(name: str) -> Iterator[None]:
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        with _lock:
+            _hist(f"{name}_seconds").observe(dt)
+        tr = _current.get()
+        if tr is not None:
+            tr.spans.append((name, dt))
+
+# Record a value (latency measured elsewhere, token count, candidate count, ...) in a histogram
+def observe(name: str, value: float):
+    if not _enabled:
+        return
+    with _lock:
+        _hist(name).observe(value)
+    tr = _current.get()
+    if tr is not None:
+        tr.values[name] = value
+
+def inc(name: str, n: float = 1):
+    if not _enabled or not n:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+    tr = _current.get()
+    if tr is not None:
+        tr.values[name] = tr.values.get(name, 0) + n
+
+def gauge(name: str, value: float):
+    if not _enabled:
+        return
+    with _lock:
+        _gauges[name] = value
+
+# Collect everything timed while serving one request (yields None when disabled); finished traces go to the JSONL log
+@contextmanager
+def trace(name: str = "request") -> Iterator[Trace | None]:
+    if not _enabled:
+        yield None
+        return
+    tr = Trace(name)
+    token = _current.set(tr)
+    try:
+        yield tr
+    finally:
+        _current.reset(token)
+        tr.seconds = time.perf_counter() - tr.start
+        if _trace_path is not None:
+            line = json.dumps(tr.to_dict(), ensure_ascii=False)
+            with _lock, open(_trace_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+# Time a batch stage; its throughput is kept as gauges (always measured, it costs one clock read per stage)
+@contextmanager
+def stage(name: str) -> Iterator[Stage]:
+    st = Stage(name)
+    t0 = time.perf_counter()
+    try:
+        yield st
+    finally:
+        st.seconds = time.perf_counter() - t0
+        gauge(f"{name}_items", st.items)
+        gauge(f"{name}_items_per_second", st.rate)
+
+# Prometheus text exposition format
+def prometheus_text() -> str:
+    lines = []
+    with _lock:
+        for name, v in sorted(_counters.items()):
+            lines += [f"# TYPE {PREFIX}{name} counter", f"{PREFIX}{name} {v}"]
+        for name, v in sorted(_gauges.items()):
+            lines += [f"# TYPE {PREFIX}{name} gauge", f"{PREFIX}{name} {v}"]
+        for name, h in sorted(_hists.items()):
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            cum = 0
+            for le, c in zip([*map(str, h.buckets), "+Inf"], h.counts):
+                cum += c
+                lines.append(f'{PREFIX}{name}_bucket{{le="{le}"}} {cum}')
+            lines += [f"{PREFIX}{name}_sum {h.sum}", f"{PREFIX}{name}_count {h.count}"]
+    return "\n".join(lines) + "\n"
+
+# Write the Prometheus file if one is configured (e.g. for node_exporter's textfile collector)
+def export():
+    if not _enabled or _prom_path is None:
+        return
+    tmp = _prom_path.with_name(_prom_path.name + ".tmp")
+    tmp.write_text(prometheus_text(), encoding="utf-8")
+    tmp.replace(_prom_path)
+
+# Serve GET /metrics on a background thread
+def serve(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args): pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,17 +1,219 @@
 # Ties together retriever and LLM for a chat-based RAG pipeline.
 
+import hashlib, json, sqlite3, threading, time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterator
+import numpy as np
+import requests
 from .prompt import render_prompt
+from .chunk import TokenSizer, encoding_for
+from .embed import CachedEmbedder
+from .index import serving_config
+from .shards import open_index
+from .retrieve import Retriever
+from .llm import LLM
+from . import metrics
+
+NO_ANSWER = "I don't know based on my resources."
+
+# Answers to earlier questions, found again by cosine similarity of the query embedding.
+# An entry only matches if the new query retrieved exactly the same context (chunk ids and texts, same LLM), so a
+# re-ingest or model switch can never serve a stale answer. Bounded by max_items (least recently used goes first)
+# and ttl_sec; with a path, entries are also kept in SQLite and survive restarts.
+class AnswerCache:
+    def __init__(self, threshold: float = 0.95, max_items: int = 1024, ttl_sec: float = 86400, path: str | None = None):
+        self.threshold = threshold
+        self.max_items = max_items
+        self.ttl_sec = ttl_sec
+        self.entries: OrderedDict[str, Dict] = OrderedDict() # key -> {"context", "vec", "answer", "sources", "created"}, LRU order
+        self.lock = threading.Lock() # Streamlit serves sessions from several threads
+        self.hits = self.misses = 0
+        self.db = None
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, context TEXT, vec BLOB, answer TEXT, sources TEXT, created REAL, used REAL)")
+            self.db.execute("DELETE FROM answers WHERE created < ?", (time.time() - ttl_sec,))
+            for key, context, vec, answer, sources, created in self.db.execute(
+                    "SELECT key, context, vec, answer, sources, created FROM answers ORDER BY used DESC LIMIT ?", (max_items,)).fetchall()[::-1]:
+                self.entries[key] = {"context": context, "vec": np.frombuffer(vec, dtype=np.float32), "answer": answer,
+                                     "sources": json.loads(sources), "created": created}
+            self.db.commit()
+
+    # Create the cache from the `answer_cache:` section of the config (None if missing or disabled)
+    @staticmethod
+    def from_config(cache_cfg: Dict) -> "AnswerCache | None":
+        if not cache_cfg.get("enabled", False):
+            return None
+        return AnswerCache(cache_cfg.get("threshold", 0.95), cache_cfg.get("max_items", 1024), cache_cfg.get("ttl_sec", 86400), cache_cfg.get("path"))
+
+    # Fingerprint of everything the answer depends on besides the question: the model and the retrieved chunks, in order
+    @staticmethod
+    def context_key(model: str, docs: list[dict]) -> str:
+        h = hashlib.sha1(model.encode("utf-8"))
+        for d in docs:
+            h.update(f"\0{d.get('id')}\0{d['text']}".encode("utf-8"))
+        return h.hexdigest()
+
+    # Whether any live entry was answered from this context (only then does a lookup need the query embedding)
+    def has_context(self, context: str) -> bool:
+        now = time.time()
+        with self.lock:
+            return any(e["context"] == context and now - e["created"] <= self.ttl_sec for e in self.entries.values())
+
+    # Best cached answer for this query embedding and context, if its similarity clears the threshold (query_vec=None: a miss)
+    def get(self, query_vec: np.ndarray | None, context: str) -> Dict | None:
+        now = time.time()
+        with self.lock:
+            best, best_sim = None, self.threshold
+            for key, e in list(self.entries.items()):
+                if now - e["created"] > self.ttl_sec: # expired
+                    self._drop(key)
+                elif e["context"] == context and query_vec is not None:
+                    sim = float(e["vec"] @ query_vec) # embeddings are normalized
+                    if sim >= best_sim:
+                        best, best_sim = key, sim
+            if best is None:
+                self.misses += 1
+                metrics.inc("answer_cache_misses_total")
+                return None
+            self.hits += 1
+            metrics.inc("answer_cache_hits_total")
+            self.entries.move_to_end(best)
+            if self.db is not None:
+                self.db.execute("UPDATE answers SET used = ? WHERE key = ?", (now, best))
+                self.db.commit()
+            e = self.entries[best]
+            return {"answer": e["answer"], "sources": list(e["sources"])}
+
+    def put(self, query_vec: np.ndarray, context: str, answer: str, sources: list[str]):
+        vec = np.asarray(query_vec, dtype=np.float32)
+        key = hashlib.sha1(context.encode("utf-8") + vec.tobytes()).hexdigest()
+        now = time.time()
+        with self.lock:
+            self.entries[key] = {"context": context, "vec": vec, "answer": answer, "sources": list(sources), "created": now}
+            self.entries.move_to_end(key)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (key, context, vec.tobytes(), answer, json.dumps(sources), now, now))
+            while len(self.entries) > self.max_items: # evict least recently used
+                self._drop(next(iter(self.entries)))
+            if self.db is not None:
+                self.db.commit()
+
+    def _drop(self, key: str):
+        del self.entries[key]
+        if self.db is not None:
+            self.db.execute("DELETE FROM answers WHERE key = ?", (key,))
+
+    # Hit/miss counters
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
 
 class ChatRAG:
-    def __init__(self, retriever, llm, min_score=0.25):
+    def __init__(self, retriever, llm, min_score=0.25, cache: AnswerCache | None = None, context_tokens: int | None = None):
         self.retriever = retriever
         self.llm = llm
         self.min_score = min_score
+        self.cache = cache
+        self.context_tokens = context_tokens # token budget of the packed context (None: everything retrieved)
+        self._sizer = None
+
+    # Counts tokens the way the answering model does; loaded on first use (tiktoken may have to download the encoding)
+    @property
+    def sizer(self) -> TokenSizer:
+        if self._sizer is None:
+            self._sizer = TokenSizer(encoding_for(self.llm.model))
+        return self._sizer
+
+    # Assemble the serving stack from the config (index from the snapshot if there is one)
+    @staticmethod
+    def from_config(cfg) -> "ChatRAG":
+        embedder = CachedEmbedder.from_config(cfg.embeddings) # query embeddings are cached across requests and runs
+        index_cfg = serving_config(cfg.index)
+        ix = open_index(index_cfg) # shard workers when ingest wrote shards
+        retriever = Retriever.from_config(cfg.retriever, ix, embedder, index_cfg.get("lexical_path"))
+        return ChatRAG(retriever, LLM(**cfg.llm), cfg.retriever["min_score"], AnswerCache.from_config(cfg.answer_cache),
+                       cfg.retriever.get("context_tokens"))
+
+    # Pay the one-time costs (model loads, first index reads) before the first question instead of during it
+    def warm_up(self):
+        self.retriever.warm_up()
+        if self.context_tokens is not None: # the budget is counted on every question
+            self.sizer.count("warm-up")
+        try:
+            self.llm.warm_up()
+        except requests.RequestException as e: # the LLM may come up later; questions will retry it
+            print(f"LLM warm-up failed: {e}")
     
-    def answer(self, question: str): # Answer a question using retrieval and LLM
-        docs, scores = self.retriever.retrieve(question) # retrieve documents
+    # Prompt and source URLs for already retrieved documents; prompt is None when they are not good enough to answer
+    def build_prompt(self, question: str, docs: list[dict], scores: list[float]) -> tuple[str | None, list[str]]:
         if not docs or max(scores) < self.min_score: # if no good docs
-            return {"answer": "I don't know based on my resources.", "sources": []} # return default answer
-        prompt, urls = render_prompt(question, docs) # render prompt
+            metrics.inc("no_answer_total")
+            return None, []
+        with metrics.span("render_prompt"):
+            sizer = self.sizer if self.context_tokens is not None else None # no budget, nothing to count
+            prompt, urls = render_prompt(question, docs, self.context_tokens, sizer) # deduplicated context within the budget
+        if metrics.enabled(): # tokenizing the prompt is only worth it when someone looks at the numbers
+            metrics.observe("prompt_tokens", self.sizer.count(prompt))
+        return prompt, urls
+
+    # Retrieve for a question; with a cache, also look up an earlier answer for the same context (None on a miss)
+    def _retrieve(self, question: str):
+        with metrics.span("retrieve"):
+            return self._retrieve_cached(question)
+
+    def _retrieve_cached(self, question: str):
+        docs, scores = self.retriever.retrieve(question) # BM25 fast path first: decisive questions are never embedded here
+        return (docs, scores) + self._cache_lookup(question, docs)
+
+    # query_vec, context and cached answer for retrieved docs (all None without a cache). The question is only embedded
+    # when an entry shares its context; after a dense search that is a hit in the embedder's cache, not a model call.
+    def _cache_lookup(self, question: str, docs: list[dict]) -> tuple:
+        if self.cache is None:
+            return None, None, None
+        context = AnswerCache.context_key(f"{self.llm.provider}:{self.llm.model}", docs)
+        query_vec = self._query_vec(question) if self.cache.has_context(context) else None
+        return query_vec, context, self.cache.get(query_vec, context)
+
+    def _query_vec(self, question: str) -> np.ndarray:
+        return self.retriever.embedder.encode([question])[0]
+
+    # _retrieve for several questions at once: one embedding batch and one index search (the HTTP service's micro-batches)
+    def retrieve_many(self, questions: list[str]) -> list[tuple]:
+        with metrics.span("retrieve_batch"):
+            return [(docs, scores) + self._cache_lookup(q, docs) for q, (docs, scores) in zip(questions, self.retriever.retrieve_batch(questions))]
+
+    def answer(self, question: str, retrieved: tuple | None = None): # Answer a question using retrieval and LLM
+        docs, scores, query_vec, context, hit = retrieved or self._retrieve(question) # retrieve documents (unless done in a batch)
+        if hit is not None: # same context as a near-identical earlier question: no prompt, no generation
+            return hit
+        prompt, urls = self.build_prompt(question, docs, scores)
+        if prompt is None:
+            return {"answer": NO_ANSWER, "sources": []} # return default answer
         out = self.llm.generate(prompt) # generate answer
-        return {"answer": out, "sources": urls} # return answer and sources
\ No newline at end of file
+        if self.cache is not None:
+            self.cache.put(self._query_vec(question) if query_vec is None else query_vec, context, out, urls)
+        return {"answer": out, "sources": urls} # return answer and sources
+
+    # Streaming variant of answer(): yields the list of source URLs first, then the answer text piece by piece
+    def answer_stream(self, question: str, retrieved: tuple | None = None) -> Iterator:
+        docs, scores, query_vec, context, hit = retrieved or self._retrieve(question) # retrieve documents (unless done in a batch)
+        if hit is not None: # cached answer arrives in one piece
+            yield hit["sources"]
+            yield hit["answer"]
+            return
+        prompt, urls = self.build_prompt(question, docs, scores)
+        if prompt is None:
+            yield [] # no sources
+            yield NO_ANSWER
+            return
+        yield urls # sources are known before generation starts
+        parts = []
+        for piece in self.llm.generate_stream(prompt): # stream answer tokens
+            parts.append(piece)
+            yield piece
+        if self.cache is not None: # only complete answers are cached
+            self.cache.put(self._query_vec(question) if query_vec is None else query_vec, context, "".join(parts), urls)
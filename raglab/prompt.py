@@ -1,24 +1,62 @@
 # Builds prompts for LLMs using provided context documents.
 
-# Uses a system prompt and a template to format the final prompt.
+# Uses a system prompt and a template to format the final prompt. Everything static comes first (PREFIX), so
+# Ollama's KV cache and OpenAI's prompt caching can reuse it across requests; only context and question vary.
+
+from .chunk import TokenSizer, split_paragraphs
 
 SYSTEM = (
     "You are a helpful assistant specialized in the configured domain. "
     "Use ONLY the provided context to answer. If the answer is not in the context, say you don't know. "
-    "Cite sources with [n] markers that map to the provided URLs"
+    "Cite sources with [n] markers that map to the provided URLs. "
+    "Reply with: answer first, then 'Sources:' followed by [n]->URL pairs."
 )
 
+PREFIX = f"<system>\n{SYSTEM}\n</system>\n" # identical for every request
+
 TEMPLATE = (
-    "<system>\n{system}\n</system>\n"
     "<context>\n{context}\n</context>\n"
     "<question>\n{question}\n</question>\n"
-    "Reply with: answer first, then 'Sources:' followed by [n]->URL pairs."
 )
 
-def render_prompt(question: str, docs: list[dict]) -> tuple[str, list[str]]: # Render prompt with context documents
-    ctx_lines, urls = [], [] # context lines and URLs
-    for i, d in enumerate(docs, 1):
-        ctx_lines.append(f"[{i}] {d['text']}") # add source marker
-        urls.append(d["url"]) # collect URLs
-    context = "\n\n".join(ctx_lines) # join context lines
-    return TEMPLATE.format(system=SYSTEM, context=context, question=question), urls # return prompt and URLs
\ No newline at end of file
+# Pack retrieved chunks into source blocks, one per unique URL, within max_tokens (None: no limit).
+# Paragraphs are taken in retrieval order; one already included, or contained in one (like the chunker's overlap
+# tails), is skipped, and one that contains included fragments replaces them. Paragraphs that no longer fit are dropped.
+# Chunks of the same URL are merged into one block in page order (the chunk's "pos" on its page); tokens are only
+# counted when there is a budget.
+def pack_context(docs: list[dict], max_tokens: int | None, sizer: TokenSizer | None) -> tuple[list[str], list[str]]:
+    included = {} # normalized paragraph -> (url, (chunk position, paragraph index), paragraph, tokens)
+    opened = set() # urls whose block header is already counted
+    used = 0
+    for rank, d in enumerate(docs):
+        for j, para in enumerate(split_paragraphs(d["text"])):
+            key = " ".join(para.split())
+            if any(key in k for k in included): # already in the context
+                continue
+            covered = [k for k in included if k in key] # fragments this paragraph makes redundant
+            n = header = freed = 0
+            if max_tokens is not None:
+                n = sizer.count(para)
+                header = 0 if d["url"] in opened else sizer.count(f"[{len(opened) + 1}] {d['url']}\n")
+                freed = sum(included[k][3] for k in covered)
+                if used - freed + n + header > max_tokens: # doesn't fit, a smaller paragraph still might
+                    continue
+            for k in covered:
+                del included[k]
+            opened.add(d["url"])
+            used += n + header - freed
+            included[key] = (d["url"], (d.get("pos", rank), j), para, n) # indexes without "pos": retrieval order
+    blocks, urls = [], []
+    for url in dict.fromkeys(d["url"] for d in docs): # sources in order of their best chunk
+        paras = sorted((order, para) for u, order, para, _ in included.values() if u == url)
+        if paras:
+            urls.append(url)
+            blocks.append(f"[{len(urls)}] {url}\n" + "\n\n".join(para for _, para in paras))
+    return blocks, urls
+
+def render_prompt(question: str, docs: list[dict], max_context_tokens: int | None = None, sizer: TokenSizer | None = None) -> tuple[str, list[str]]: # Render prompt with context documents
+    if max_context_tokens is not None and sizer is None:
+        sizer = TokenSizer()
+    blocks, urls = pack_context(docs, max_context_tokens, sizer) # numbered source blocks and their URLs
+    context = "\n\n".join(blocks) # join context blocks
+    return PREFIX + TEMPLATE.format(context=context, question=question), urls # return prompt and URLs
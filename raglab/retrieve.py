@@ -1,53 +1,132 @@
 # Search strategy: retrieve top-k documents using an index and an embedder, with optional MMR re-ranking
 
+import time
+from pathlib import Path
 import numpy as np
 from typing import List, Dict, Tuple
+from .lexical import LexicalIndex, rrf
+from . import metrics
 
 # Cosine similarity on normalized embeddings -> dot product
 
-def mmr(doc_embs: np.ndarray, query_emb: np.ndarray, k: int, lam: float = 0.5) -> List[int]:
-    idxs = list(range(len(doc_embs))) # candidate indices
-    selected = [] # selected indices
-    sims = doc_embs @ query_emb # cosine similarities
-    while len(selected) < min(k, len(idxs)): # while we need more selections
-        if not selected: # if nothing selected yet, pick the most similar
-            i = int(np.argmax(sims))
-            selected.append(i)
-            continue
-        # diversity term
-        max_div = -1
-        best = None
-        for i in idxs:
-            if i in selected: continue # already selected
-            diversity = max(doc_embs[i] @ doc_embs[j] for j in selected) if selected else 0 # max similarity to selected
-            score = lam * sims[i] - (1 - lam) * diversity # MMR score
-            if score > max_div:
-                max_div = score
-                best = i
-        selected.append(best) # add best to selected
-    return selected[:k] # return top k selected
-
-# Class for retrieving documents using an index and an embedder
+def mmr(doc_embs: np.ndarray, query_emb: np.ndarray, k: int, lam: float = 0.5, relevance: np.ndarray | None = None) -> List[int]:
+    return mmr_batch(doc_embs[None], query_emb[None], k, lam, None if relevance is None else relevance[None])[0].tolist() # single query is a batch of one
+
+# Batched MMR: doc_embs is (Q, n, d), query_embs is (Q, d); returns (Q, min(k, n)) selected indices.
+# relevance (Q, n) replaces the query-candidate similarities when given (e.g. fused hybrid scores).
+def mmr_batch(doc_embs: np.ndarray, query_embs: np.ndarray, k: int, lam: float = 0.5, relevance: np.ndarray | None = None) -> np.ndarray:
+    doc_embs = np.asarray(doc_embs, dtype=np.float32)
+    query_embs = np.asarray(query_embs, dtype=np.float32)
+    Q, n = doc_embs.shape[:2]
+    k = min(k, n)
+    rows = np.arange(Q)
+    selected = np.empty((Q, k), dtype=np.int64)
+    if k == 0:
+        return selected
+    sims = np.matmul(doc_embs, query_embs[:, :, None])[:, :, 0] if relevance is None else np.asarray(relevance, dtype=np.float32) # query-candidate similarities
+    taken = np.zeros((Q, n), dtype=bool) # selection mask instead of list membership checks
+    best = np.argmax(sims, axis=1) # first pick: most similar to the query
+    max_sim = np.full((Q, n), -np.inf, dtype=np.float32) # running max similarity to the selected set
+    for step in range(k):
+        if step:
+            score = lam * sims - (1 - lam) * max_sim # MMR score
+            score[taken] = -np.inf # never pick twice
+            best = np.argmax(score, axis=1) # ties resolve to the lowest index, like the scalar loop
+        selected[:, step] = best
+        taken[rows, best] = True
+        picked_sim = np.matmul(doc_embs, doc_embs[rows, best][:, :, None])[:, :, 0] # one column of the candidate-candidate matrix
+        np.maximum(max_sim, picked_sim, out=max_sim) # update with the newly picked item only
+    return selected
+
+# Class for retrieving documents using an index and an embedder.
+# With a lexical (BM25) index: mode="hybrid" fuses dense and lexical candidates by reciprocal rank, and
+# fast_path_margin answers queries from BM25 alone, without encoding them, when its best hit leads the runner-up
+# by that fraction of its score (e.g. an exact API name); those results are scored relative to the best hit.
 class Retriever:
 
-    def __init__(self, index, embedder, top_k=5, use_mmr=True, mmr_lambda=0.5):
+    def __init__(self, index, embedder, top_k=5, use_mmr=True, mmr_lambda=0.5, lexical=None, mode="dense", rrf_k=60, fast_path_margin=None):
         self.index = index
         self.embedder = embedder
         self.top_k = top_k
         self.use_mmr = use_mmr
         self.mmr_lambda = mmr_lambda
+        self.lexical = lexical
+        self.mode = mode
+        self.rrf_k = rrf_k
+        self.fast_path_margin = fast_path_margin
+        if (mode == "hybrid" or fast_path_margin is not None) and lexical is None:
+            raise ValueError("hybrid retrieval and the lexical fast path need a lexical index (run ingest.py)")
+
+    # Create a retriever from the `retriever:` section of the config; the BM25 index is only loaded if it is used
+    @staticmethod
+    def from_config(retr_cfg: Dict, index, embedder, lexical_path: str | None = None) -> "Retriever":
+        mode, margin = retr_cfg.get("mode", "dense"), retr_cfg.get("lexical_fast_path")
+        lexical = None
+        if (mode == "hybrid" or margin is not None) and lexical_path and Path(lexical_path).exists():
+            lexical = LexicalIndex.load(lexical_path)
+        return Retriever(index, embedder, retr_cfg["top_k"], retr_cfg["use_mmr"], retr_cfg["mmr_lambda"], lexical, mode, retr_cfg.get("rrf_k", 60), margin)
+
+    # Touch every serving structure once: load the embedding model, then search the dense and BM25 indexes
+    def warm_up(self):
+        q = self.embedder.warm_up()
+        self.index.search_batch(q, self.top_k * 4, return_vectors=True)
+        if self.lexical is not None:
+            self.lexical.search_batch(["warm-up"], self.top_k)
+
+    # Retrieve documents for a given query (query_vec: its embedding, if the caller already has it)
+    def retrieve(self, query: str, query_vec: np.ndarray | None = None) -> Tuple[List[Dict], List[float]]:
+        return self.retrieve_batch([query], query_vecs=None if query_vec is None else query_vec[None])[0]
+
+    # Retrieve documents for many queries: one encode call, one FAISS search, MMR per row (batched when shapes allow).
+    # If a timings dict is given, it receives the seconds spent in each stage for the whole batch.
+    # query_vecs: embeddings the caller already has (e.g. for the answer cache); the lexical fast path still applies.
+    def retrieve_batch(self, queries: List[str], timings: Dict | None = None, query_vecs: np.ndarray | None = None) -> List[Tuple[List[Dict], List[float]]]:
+        timings = {} if timings is None else timings
+        timings.update(lexical=0.0, embed=0.0, search=0.0, mmr=0.0)
+        if not queries:
+            return []
+        n_cand = self.top_k * 4 if self.use_mmr or self.mode == "hybrid" else self.top_k
+        results, lex = [None] * len(queries), None
+        if self.lexical is not None and (self.mode == "hybrid" or self.fast_path_margin is not None):
+            t0 = time.perf_counter()
+            with metrics.span("lexical_search"):
+                lex = self.lexical.search_batch(list(queries), n_cand)
+            if self.fast_path_margin is not None:
+                for i, (scores, ids) in enumerate(lex):
+                    if len(scores) and (len(scores) == 1 or scores[0] - scores[1] >= self.fast_path_margin * scores[0]): # decisive lexical winner
+                        results[i] = (self.index.lookup(ids[:self.top_k]), list(map(float, scores[:self.top_k] / scores[0])))
+                        metrics.inc("lexical_fast_path_total")
+            timings["lexical"] = time.perf_counter() - t0
+        todo = [i for i, r in enumerate(results) if r is None]
+        if not todo:
+            return results
 
-    # Retrieve documents for a given query
-    def retrieve(self, query: str) -> Tuple[List[Dict], List[float]]:
-        q = self.embedder.encode([query]) # encode query
-        scores, docs = self.index.search(q, max(self.top_k * 4 if self.use_mmr else self.top_k, self.top_k)) # search index
-        if self.use_mmr: # apply MMR re-ranking
-            doc_embs = self.embedder.encode([doc["text"] for doc in docs]) # encode documents
-            order = mmr(doc_embs, q[0], self.top_k, self.mmr_lambda) # get MMR order
-            docs = [docs[i] for i in order] # reorder documents
-            scores = [float((doc_embs[i] @ q[0])) for i in order] # recompute scores
-        else: # truncate to top_k
-            docs = docs[:self.top_k] # truncate documents
-            scores = scores[:self.top_k] # truncate scores
-        return docs, list(map(float, scores)) # return documents and scores
-        
\ No newline at end of file
+        t0 = time.perf_counter()
+        q = self.embedder.encode([queries[i] for i in todo]) if query_vecs is None else np.asarray(query_vecs)[todo] # encode remaining queries
+        t1 = time.perf_counter()
+        timings["embed"] = t1 - t0
+        if not self.use_mmr and self.mode != "hybrid": # plain top_k
+            hits = self.index.search_batch(q, self.top_k) # search index
+            for i, (scores, docs) in zip(todo, hits):
+                results[i] = (docs[:self.top_k], list(map(float, scores[:self.top_k])))
+            timings["search"] = time.perf_counter() - t1
+            return results
+        hits = self.index.search_batch(q, n_cand, return_vectors=True) # search index, reuse stored embeddings
+        relevance = None
+        if self.mode == "hybrid": # candidate pool: best n_cand of the rank-fused dense and lexical lists
+            fused = [rrf([[d["id"] for d in docs], lex[i][1].tolist()], self.rrf_k)[:n_cand] for i, (_, docs, _) in zip(todo, hits)]
+            hits = [(None, *self.index.lookup([i for i, _ in f], return_vectors=True)) for f in fused]
+            relevance = [np.array([s for _, s in f]) / (f[0][1] if f else 1.0) for f in fused] # fused score relative to the best, for MMR
+        t2 = time.perf_counter()
+        timings["search"] = t2 - t1
+        with metrics.span("mmr"):
+            if not self.use_mmr: # fused order
+                orders = [list(range(min(self.top_k, len(docs)))) for _, docs, _ in hits]
+            elif len({len(docs) for _, docs, _ in hits}) == 1: # same candidate count for every query: one (Q, n, d) MMR call
+                orders = mmr_batch(np.stack([embs for _, _, embs in hits]), q, self.top_k, self.mmr_lambda, None if relevance is None else np.stack(relevance)).tolist()
+            else:
+                orders = [mmr(embs, q[r], self.top_k, self.mmr_lambda, None if relevance is None else relevance[r]) for r, (_, _, embs) in enumerate(hits)]
+        for r, (i, (_, docs, doc_embs), order) in enumerate(zip(todo, hits, orders)):
+            results[i] = ([docs[j] for j in order], [float(doc_embs[j] @ q[r]) for j in order]) # reorder documents, recompute scores
+        timings["mmr"] = time.perf_counter() - t2
+        return results
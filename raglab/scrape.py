@@ -1,12 +1,16 @@
 # Web scraping module for crawling and extracting text from web pages
 
-import re, time, hashlib, json
+import re, time, hashlib, json, threading, multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 from urllib.parse import urlparse, urljoin
 import requests
+from requests.adapters import HTTPAdapter
 import trafilatura
-from bs4 import BeautifulSoup
+import lxml.html
 from tqdm import tqdm
+from . import metrics
 
 USER_AGENT = "Mozilla/5.0 (RAG-edu-bot)"
 
@@ -22,62 +26,166 @@ def in_domain(url: str, seed_domain: str) -> bool:
     parsed = urlparse(url)
     return seed_domain in parsed.netloc
 
-# Extract and normalize links from HTML content
-def extract_links(html: str, base: str) -> list[str]:
-    soup = BeautifulSoup(html, "html.parser") # Parse HTML
+# Parse HTML once with lxml (None if there is nothing to parse)
+def parse_html(html: str):
+    try:
+        return lxml.html.fromstring(html.encode("utf-8"), parser=lxml.html.HTMLParser(encoding="utf-8"))
+    except (lxml.etree.ParserError, ValueError):
+        return None
+
+def _links(tree, base: str) -> list[str]:
     links = []
-    for a in soup.find_all("a", href=True): # Find all anchor tags with href
-        href = urljoin(base, a['href']) # Resolve relative URLs
+    for href in tree.xpath("//a/@href"): # All anchor hrefs
+        href = urljoin(base, href) # Resolve relative URLs
         if href.startswith("http"):
             links.append(normalize(href))
     return links
 
-# Fetch URL content with timeout and return HTML and extracted text
-def fetch(url: str, timeout=15) -> tuple[str, str] | None:
+# Extract and normalize links from HTML content
+def extract_links(html: str, base: str) -> list[str]:
+    tree = parse_html(html)
+    return _links(tree, base) if tree is not None else []
+
+# Extraction stage (runs in a worker process): main text and links from a single parse.
+# If the text is already known (page unchanged since last crawl) only the links are extracted.
+def extract_page(html: str, url: str, text: str | None = None) -> tuple[str, list[str]]:
+    tree = parse_html(html)
+    if tree is None:
+        return text or "", []
+    links = _links(tree, url) # before trafilatura, which prunes the tree it is given
+    if text is None:
+        text = trafilatura.extract(tree, include_comments=False) or ""
+    return text, links
+
+# Shared HTTP session: keep-alive connections, pool sized for the number of crawl threads
+def make_session(pool_size: int = 10) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+# Per-host politeness: at most `rps` requests per second to any single host (0 disables)
+class HostRateLimiter:
+    def __init__(self, rps: float = 0):
+        self.interval = 1.0 / rps if rps > 0 else 0.0
+        self.next_slot: dict[str, float] = {} # host -> earliest time of its next request
+        self.lock = threading.Lock()
+
+    def wait(self, url: str):
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        with self.lock: # reserve a slot, then sleep outside the lock
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+# Fetch URL content with timeout; returns HTML and cache validators (text extraction is a separate stage).
+# With validators from a previous crawl the GET is conditional and a 304 returns {"not_modified": True}.
+def fetch(url: str, timeout=15, validators: dict | None = None, session: requests.Session | None = None) -> dict | None:
     headers = {"User-Agent": USER_AGENT}
+    if validators and validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators and validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
     try:
-        response = requests.get(url, headers=headers, timeout=timeout)
+        response = (session or requests).get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304:
+            return {"not_modified": True}
         if response.status_code == 200 and 'text/html' in response.headers.get('Content-Type', ''):
-            html = response.text
-            text = trafilatura.extract(html, include_comments=False) or ""
-            return html, text
+            return {"html": response.text, "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
     except requests.RequestException:
         return None
     return None
 
-# Crawl starting from seed URLs, respecting domain and page limits
-def crawl(seeds: list[str], seed_domain: str, out_dir: Path, max_pages=400, same_domain_only=True):
+# Crawl starting from seed URLs, respecting domain and page limits, yielding documents as soon as their turn comes.
+# validators maps url -> {"etag", "last_modified"} from the previous ingest; unchanged pages are served from raw/.
+# Two stages: up to `concurrency` pages are fetched at once over one shared session (at most `per_host_rps` per host),
+# and text/link extraction runs on a pool of `extract_workers` processes (default: one per CPU). Pages finish in any
+# order but are committed (yielded, links enqueued) in the order they left the frontier, so any concurrency crawls the
+# same pages in the same order as a serial crawl.
+def crawl(seeds: list[str], seed_domain: str, out_dir: Path, max_pages=400, same_domain_only=True, validators: dict | None = None,
+          timeout=15, concurrency=1, per_host_rps=0, extract_workers=None):
     out_dir.mkdir(parents=True, exist_ok=True)
     raw_dir = out_dir / "raw" # Directory for raw HTML and text
     raw_dir.mkdir(exist_ok=True)
-    seen, queue = set(), list(map(normalize, seeds)) # Initialize seen set and queue with normalized seeds
-    docs = []
-
-    with tqdm(total=max_pages, desc="Crawl") as pbar:
-        while queue and len(docs) < max_pages:
-            url = queue.pop(0)
-            if url in seen: continue
-            seen.add(url)
-
-            resp = fetch(url)
-            if not resp: continue
-            html, text = resp
-            if not text.strip(): # Skip if no text extracted
-                continue
-
-            # Save raw HTML and text
-            h = hashlib.md5(url.encode()).hexdigest() # Create a hash of the URL for filename
-            (raw_dir / f"{h}.html").write_text(html, encoding="utf-8")
-            
-            docs.append({"url": url, "text": text}) # Store URL and text
-            pbar.update(1) # Update progress bar
-
-            # Discover links
-            for link in set(extract_links(html, url)):
-                if same_domain_only and not in_domain(link, seed_domain):
-                    continue
-                if link not in seen:
-                    queue.append(link)
-
-    return docs
-                
\ No newline at end of file
+    validators = validators or {}
+    queue = deque(dict.fromkeys(map(normalize, seeds))) # Frontier, deduplicated seeds in order
+    seen = set(queue) # Everything ever enqueued, checked before enqueueing so the frontier holds no duplicates
+    produced = 0
+    session, limiter = make_session(concurrency), HostRateLimiter(per_host_rps)
+    # Extraction workers are started while fetch threads may hold locks (session, logging): never fork this process
+    start = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    fetch_pool = ThreadPoolExecutor(max_workers=concurrency)
+    extract_pool = ProcessPoolExecutor(max_workers=extract_workers, mp_context=multiprocessing.get_context(start))
+    fetching, extracting = {}, {} # future -> page info, for each stage
+    finished = {} # sequence number -> (url, text, links, resp), None for a failed or empty page; waits for its turn
+    dispatched = committed = 0 # sequence numbers handed out / committed, in frontier order
+
+    # Runs on a fetch thread
+    def visit(url: str, cached: bool):
+        limiter.wait(url)
+        with metrics.span("crawl_fetch"):
+            return fetch(url, timeout=timeout, validators=validators.get(url) if cached else None, session=session) # Conditional GET only if we can serve a 304 from disk
+
+    started = time.perf_counter()
+    try:
+        with tqdm(total=max_pages, desc="Crawl") as pbar:
+            while (queue or fetching or extracting) and produced < max_pages:
+                while queue and len(fetching) < concurrency and produced + dispatched - committed < max_pages: # keep fetchers busy
+                    url = queue.popleft()
+                    h = hashlib.md5(url.encode()).hexdigest() # Create a hash of the URL for filename
+                    paths = raw_dir / f"{h}.html", raw_dir / f"{h}.txt"
+                    cached = paths[0].exists() and paths[1].exists()
+                    fetching[fetch_pool.submit(visit, url, cached)] = (dispatched, url, paths)
+                    dispatched += 1
+                done, _ = wait([*fetching, *extracting], return_when=FIRST_COMPLETED)
+                for fut in done: # results of both stages are handled on this thread only
+                    if fut in fetching: # fetched: hand the HTML to the extraction stage
+                        seq, url, (html_path, text_path) = fetching.pop(fut)
+                        resp = fut.result()
+                        if not resp:
+                            metrics.inc("crawl_failed_total")
+                            finished[seq] = None
+                            continue
+                        if resp.get("not_modified"): # Unchanged since last ingest: reuse the saved copy, only links are needed
+                            metrics.inc("crawl_not_modified_total")
+                            resp = {"html": html_path.read_text(encoding="utf-8"), "text": text_path.read_text(encoding="utf-8"), **validators[url]}
+                        else: # Save raw HTML
+                            metrics.inc("crawl_bytes_total", len(resp["html"]))
+                            html_path.write_text(resp["html"], encoding="utf-8")
+                        extracting[extract_pool.submit(extract_page, resp["html"], url, resp.get("text"))] = (seq, url, text_path, resp)
+                        continue
+                    seq, url, text_path, resp = extracting.pop(fut)
+                    text, links = fut.result()
+                    if "text" not in resp: # Save extracted text
+                        text_path.write_text(text, encoding="utf-8")
+                    finished[seq] = (url, text, links, resp) if text.strip() else None # Skip if no text extracted
+
+                while committed in finished: # commit in frontier order: same pages and frontier as a serial crawl
+                    page = finished.pop(committed)
+                    committed += 1
+                    if page is None or produced >= max_pages:
+                        continue
+                    url, text, links, resp = page
+                    yield {"url": url, "text": text, "etag": resp.get("etag"), "last_modified": resp.get("last_modified")} # URL, text and validators
+                    produced += 1
+                    metrics.inc("crawl_pages_total")
+                    pbar.update(1) # Update progress bar
+
+                    # Discover links
+                    for link in dict.fromkeys(links): # dedupe, keep page order
+                        if same_domain_only and not in_domain(link, seed_domain):
+                            continue
+                        if link not in seen:
+                            seen.add(link)
+                            queue.append(link)
+    finally: # max_pages reached or consumer stopped: drop queued work
+        metrics.gauge("crawl_pages_per_second", produced / max(time.perf_counter() - started, 1e-9))
+        fetch_pool.shutdown(cancel_futures=True)
+        extract_pool.shutdown(cancel_futures=True)
+        session.close()
@@ -0,0 +1,216 @@
+# Sharded dense index: chunks are partitioned by id (id % n) into n FaissIndex shards, each with its own FAISS index,
+# metadata and vectors, described by a shards.json manifest. ShardedIndex has the search/lookup interface of FaissIndex:
+# a query batch is sent to every shard worker at once, each returns its own top-k (scores, metadata, vectors), and
+# the merged top-k by score goes to the retriever (MMR, fusion) unchanged.
+# Every shard is served by a shard server (python -m raglab.shards --dir index/shards --shard 0 --port 7100) speaking
+# pickled requests over an authenticated TCP connection. By default ShardedIndex starts one per shard on localhost,
+# with a secret made up for that launch; with addresses it connects to servers started elsewhere, a stand-in for
+# shards on other machines, which share the secret in RAGLAB_SHARD_AUTHKEY.
+
+import os, sys, json, shutil, secrets, argparse, threading, subprocess
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+from typing import Dict, List
+import numpy as np
+import faiss
+from .index import DEFAULT_PARAMS, FaissIndex, SNAPSHOT_FILES, replace_dir
+from . import metrics
+
+MANIFEST = "shards.json"
+AUTHKEY_ENV = "RAGLAB_SHARD_AUTHKEY" # shared secret of shard servers and clients; requests are unpickled, so there is no default
+
+def _authkey() -> bytes:
+    key = os.getenv(AUTHKEY_ENV)
+    if not key:
+        raise RuntimeError(f"{AUTHKEY_ENV} must be set to the secret shared by the shard servers and their clients")
+    return key.encode("utf-8")
+
+def _shard_index(directory: Path, index_type: str = "flat", params: Dict | None = None, mmap: bool = False) -> FaissIndex:
+    return FaissIndex(directory / SNAPSHOT_FILES["faiss_path"], directory / SNAPSHOT_FILES["meta_path"], directory / SNAPSHOT_FILES["vectors_path"],
+                      index_type, params, mmap)
+
+# Every id % n partition must hold chunks: an empty shard can't be built (IVF types can't even be trained). Ids become
+# sparse after incremental deletes, so this can fail with far more chunks than shards.
+def check_partition(ids, n: int):
+    counts = np.bincount(np.asarray(ids, dtype=np.int64) % n, minlength=n)
+    empty = np.flatnonzero(counts == 0)
+    if len(empty):
+        raise ValueError(f"{n} shards for {len(ids)} chunks: shard(s) {', '.join(map(str, empty))} would be empty (chunks go to shard id % {n})")
+
+# Split an index into n shards (trained separately) and swap them in as one directory, like a snapshot
+def write_shards(ix: FaissIndex, directory: str, n: int):
+    check_partition(ix.ids, n)
+    directory = Path(directory)
+    tmp = directory.with_name(directory.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    part = ix.ids % n
+    shards = []
+    for s in range(n):
+        rows = np.flatnonzero(part == s)
+        shard = _shard_index(tmp / f"shard_{s}", ix.index_type, ix.params)
+        shard.build(np.asarray(ix.vectors[rows], dtype="float32"), [ix.meta[r] for r in rows], ix.ids[rows])
+        shard.save()
+        shards.append({"dir": f"shard_{s}", "ntotal": len(rows)})
+    manifest = {"n": n, "partition": "id % n", "type": ix.index_type, "dim": int(ix.vectors.shape[1]), "ntotal": len(ix.ids), "shards": shards}
+    (tmp / MANIFEST).write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    replace_dir(tmp, directory)
+
+# Answer requests on one connection until it closes: ("search", (query_vecs, top_k, return_vectors)) or ("lookup", (ids, return_vectors))
+def _serve(conn: Connection, ix: FaissIndex):
+    while True:
+        try:
+            op, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send(("ok", ix.search_batch(*args) if op == "search" else ix.lookup(*args)))
+        except Exception as e: # report to the caller, keep serving
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+def _load_shard(directory: Path, params: Dict, threads: int) -> FaissIndex:
+    faiss.omp_set_num_threads(threads) # shards on one machine share its cores
+    ix = _shard_index(directory, params=params, mmap=True)
+    ix.load()
+    return ix
+
+class ShardedIndex:
+    def __init__(self, directory: str, params: Dict | None = None, addresses: List[str] | None = None):
+        self.dir = Path(directory)
+        self.params = params or {} # search knobs (nprobe, ef_search) for the shards
+        self.addresses = addresses # host:port of shard servers, in shard order; None starts them on localhost
+        self.manifest = json.loads((self.dir / MANIFEST).read_text(encoding="utf-8"))
+        self.n = self.manifest["n"]
+        self.conns: List[Connection] = []
+        self.procs: List[subprocess.Popen] = []
+        self.lock = threading.Lock() # one request in flight per connection
+
+    # Create the index from the `index:` section of the config
+    @staticmethod
+    def from_config(index_cfg: Dict) -> "ShardedIndex":
+        params = {k: v for k, v in index_cfg.items() if k in DEFAULT_PARAMS}
+        return ShardedIndex(index_cfg["shards_dir"], params, index_cfg.get("shard_addresses"))
+
+    # Connect to one server per shard, starting them first unless addresses were given
+    def load(self):
+        if self.addresses:
+            addresses, authkey = self.addresses, _authkey()
+            if len(addresses) != self.n:
+                raise ValueError(f"{len(addresses)} shard addresses for {self.n} shards")
+        else:
+            authkey = secrets.token_hex(32).encode("utf-8") # only this process and its servers know it
+            addresses = self._start_servers(authkey)
+        for addr in addresses:
+            host, port = addr.rsplit(":", 1)
+            self.conns.append(Client((host, int(port)), authkey=authkey))
+
+    # Local servers on free ports; they load in parallel and exit when this process goes away (their stdin closes)
+    def _start_servers(self, authkey: bytes) -> List[str]:
+        threads = max(1, (os.cpu_count() or 1) // self.n)
+        env = {**os.environ, AUTHKEY_ENV: authkey.decode("utf-8"),
+               "PYTHONPATH": os.pathsep.join(filter(None, [str(Path(__file__).resolve().parents[1]), os.getenv("PYTHONPATH")]))}
+        for s in range(self.n):
+            cmd = [sys.executable, "-m", "raglab.shards", "--dir", str(self.dir), "--shard", str(s), "--port", "0",
+                   "--threads", str(threads), "--params", json.dumps(self.params), "--exit-with-stdin"]
+            self.procs.append(subprocess.Popen(cmd, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True))
+        addresses = []
+        for s, p in enumerate(self.procs):
+            line = p.stdout.readline() # "Shard i (n vectors) on host:port" once loaded
+            if not line:
+                self.close()
+                raise RuntimeError(f"shard server {s} exited during startup")
+            addresses.append(line.split()[-1])
+        return addresses
+
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+        for p in self.procs:
+            p.stdin.close() # the server exits
+            p.wait(timeout=5)
+        self.conns, self.procs = [], []
+
+    # Send each shard its request, then collect the replies (shards work concurrently)
+    def _call(self, requests: Dict[int, tuple]) -> Dict[int, object]:
+        with self.lock:
+            for s, req in requests.items():
+                self.conns[s].send(req)
+            replies = {s: self.conns[s].recv() for s in requests}
+        for s, (status, value) in replies.items():
+            if status != "ok":
+                raise RuntimeError(f"shard {s}: {value}")
+        return {s: value for s, (_, value) in replies.items()}
+
+    # Same contract as FaissIndex.lookup: metadata (and vectors) of chunks by id, in the given order
+    def lookup(self, ids, return_vectors: bool = False):
+        ids = np.asarray(ids, dtype=np.int64)
+        owner = ids % self.n
+        replies = self._call({int(s): ("lookup", (ids[owner == s], return_vectors)) for s in np.unique(owner)})
+        docs, vecs = [None] * len(ids), [None] * len(ids)
+        for s, reply in replies.items():
+            for j, pos in enumerate(np.flatnonzero(owner == s)):
+                if return_vectors:
+                    docs[pos], vecs[pos] = reply[0][j], reply[1][j]
+                else:
+                    docs[pos] = reply[j]
+        if not return_vectors:
+            return docs
+        return docs, np.stack(vecs) if vecs else np.zeros((0, self.manifest["dim"]), dtype=np.float32)
+
+    def search(self, query_vec: np.ndarray, top_k: int, return_vectors: bool = False):
+        return self.search_batch(np.asarray(query_vec).reshape(1, -1), top_k, return_vectors)[0]
+
+    # Same contract as FaissIndex.search_batch: every shard returns its top_k per query, the best top_k overall are kept
+    def search_batch(self, query_vecs: np.ndarray, top_k: int, return_vectors: bool = False) -> list[tuple]:
+        q = np.ascontiguousarray(query_vecs, dtype="float32")
+        with metrics.span("shard_search"):
+            replies = self._call({s: ("search", (q, top_k, return_vectors)) for s in range(self.n)})
+        results = []
+        for r in range(len(q)):
+            parts = [replies[s][r] for s in range(self.n)] # (scores, docs[, vectors]) of each shard
+            scores = np.concatenate([p[0] for p in parts])
+            docs = [d for p in parts for d in p[1]]
+            order = np.argsort(-scores, kind="stable")[:top_k]
+            merged = (scores[order], [docs[i] for i in order])
+            if return_vectors:
+                merged += (np.concatenate([p[2] for p in parts])[order],)
+            results.append(merged)
+        return results
+
+# Dense index for serving: the shards when index.shards > 1 and ingest has written them, otherwise the single index
+# (pass the serving_config() of the `index:` section, so a snapshot is used when there is one)
+def open_index(index_cfg: Dict) -> "FaissIndex | ShardedIndex":
+    shards_dir = index_cfg.get("shards_dir")
+    if index_cfg.get("shards", 1) > 1 and shards_dir and (Path(shards_dir) / MANIFEST).exists():
+        ix = ShardedIndex.from_config(index_cfg)
+    else:
+        ix = FaissIndex.from_config(index_cfg)
+    ix.load()
+    return ix
+
+# Shard server: serves one shard to any number of clients over TCP
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dir", default="index/shards")
+    ap.add_argument("--shard", type=int, required=True)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, required=True, help="0 = any free port (printed once the shard is loaded)")
+    ap.add_argument("--threads", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--params", default="{}", help="search knobs as JSON, e.g. '{\"nprobe\": 32}'")
+    ap.add_argument("--exit-with-stdin", action="store_true", help=argparse.SUPPRESS) # started by ShardedIndex: exit with the parent
+    args = ap.parse_args()
+    try:
+        authkey = _authkey()
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+    ix = _load_shard(Path(args.dir) / f"shard_{args.shard}", json.loads(args.params), args.threads)
+    listener = Listener((args.host, args.port), authkey=authkey)
+    if args.exit_with_stdin:
+        threading.Thread(target=lambda: (sys.stdin.read(), os._exit(0)), daemon=True).start()
+    print(f"Shard {args.shard} ({ix.index.ntotal} vectors) on {args.host}:{listener.address[1]}", flush=True)
+    while True:
+        try:
+            conn = listener.accept() # nothing is unpickled before the client proves it knows the secret
+        except (AuthenticationError, EOFError, OSError): # wrong secret or dropped handshake: keep serving the others
+            continue
+        threading.Thread(target=_serve, args=(conn, ix), daemon=True).start()
@@ -0,0 +1,96 @@
+# Headless HTTP API around ChatRAG (FastAPI), for other services and load balancers: JSON and streaming answers.
+# One process holds one copy of the embedding model, index and LLM client, shared by every concurrent request;
+# their retrievals are grouped by a micro-batcher into one embedding batch and one index search. To scale out, run
+# more replicas: with an ingest snapshot the index is memory-mapped, so replicas on one host share its pages.
+#
+#   python serve.py --config config/config.yaml --port 8000
+#   curl -s localhost:8000/answer -H 'Content-Type: application/json' -d '{"question": "How do I read a CSV file?"}'
+#   curl -sN localhost:8000/answer/stream -H 'Content-Type: application/json' -d '{"question": "..."}'
+
+import json, asyncio, argparse, contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+from raglab.config import Settings
+from raglab.pipeline import ChatRAG
+from raglab.batcher import MicroBatcher
+from raglab import metrics
+
+class Question(BaseModel):
+    question: str
+
+def create_app(cfg: Settings) -> FastAPI:
+    serve_cfg = cfg.serve
+    banned = set(map(str.lower, cfg.ui.get("banned_queries", [])))
+    state = {}
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        metrics.configure(cfg.metrics)
+        rag = await asyncio.to_thread(ChatRAG.from_config, cfg) # serves the memory-mapped snapshot if ingest wrote one
+        if serve_cfg.get("warm_up", True): # load models and touch the indexes before accepting traffic
+            await asyncio.to_thread(rag.warm_up)
+        batcher = MicroBatcher(rag.retrieve_many, serve_cfg.get("max_batch", 32), serve_cfg.get("max_wait_ms", 5), "retrieve_batch")
+        batcher.start()
+        llm_pool = ThreadPoolExecutor(rag.llm.max_concurrency, thread_name_prefix="llm") # one thread per request the LLM may have in flight
+        state.update(rag=rag, batcher=batcher, llm_pool=llm_pool)
+        yield
+        await batcher.close()
+        llm_pool.shutdown(wait=False)
+        metrics.export()
+
+    app = FastAPI(title=cfg.ui.get("title", "raglab"), lifespan=lifespan)
+
+    async def retrieve(q: Question) -> tuple:
+        if not q.question.strip():
+            raise HTTPException(422, "question is empty")
+        if any(word in q.question.lower() for word in banned): # same guardrail as the UI
+            raise HTTPException(400, "Your query contains banned words. Please modify and try again.")
+        return await state["batcher"].submit(q.question)
+
+    # {"answer": ..., "sources": [...]}
+    @app.post("/answer")
+    async def answer(q: Question):
+        with metrics.trace("answer"):
+            retrieved = await retrieve(q)
+            ctx = contextvars.copy_context() # generation spans belong to this request's trace
+            return await asyncio.get_running_loop().run_in_executor(state["llm_pool"], ctx.run, state["rag"].answer, q.question, retrieved)
+
+    # NDJSON: {"sources": [...]} first, then {"delta": "..."} pieces, then {"done": true}, or {"error": "..."} as the last line
+    @app.post("/answer/stream")
+    async def answer_stream(q: Question):
+        retrieved = await retrieve(q)
+        def lines():
+            try: # prompt building runs on the first next(): its errors go in-band too
+                parts = state["rag"].answer_stream(q.question, retrieved)
+                yield json.dumps({"sources": next(parts)}) + "\n"
+                for piece in parts:
+                    yield json.dumps({"delta": piece}) + "\n"
+                yield json.dumps({"done": True}) + "\n"
+            except Exception as e: # headers are already sent: report in-band
+                yield json.dumps({"error": str(e)}) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson") # iterated on a worker thread
+
+    @app.get("/healthz")
+    async def healthz():
+        b = state["batcher"]
+        return {"status": "ok", "batches": b.batches, "batched": b.items}
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def prometheus():
+        return metrics.prometheus_text()
+
+    return app
+
+if __name__ == "__main__":
+    import uvicorn
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--config", default="config/config.yaml")
+    ap.add_argument("--host", default=None)
+    ap.add_argument("--port", type=int, default=None)
+    args = ap.parse_args()
+    cfg = Settings.load(args.config)
+    uvicorn.run(create_app(cfg), host=args.host or cfg.serve.get("host", "127.0.0.1"), port=args.port or cfg.serve.get("port", 8000),
+                log_level="warning")
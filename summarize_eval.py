@@ -1,4 +1,4 @@
-import csv, json, sys
+import csv, json, math, sys
 from collections import Counter, defaultdict
 from pathlib import Path
 
@@ -9,6 +9,11 @@ def to_bool(x):
     if isinstance(x, str): return x.strip().lower() == "true"
     return bool(x)
 
+# Nearest-rank percentile of a list of numbers
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[max(0, math.ceil(p / 100 * len(xs)) - 1)] if xs else 0.0
+
 rows = list(csv.DictReader(csv_path.open(encoding="utf-8")))
 # Basic per-strategy accuracy
 totals = Counter()
@@ -23,10 +28,20 @@ for r in rows:
     corrects[s] += ok
     by_q[qid][s] = ok
 
+# Per-strategy end-to-end latency (retrieval + MMR + generation), if the results have timing columns
+latency = defaultdict(list)
+if rows and "generation_ms" in rows[0]:
+    for r in rows:
+        latency[r["strategy"]].append(sum(float(r[c] or 0) for c in ("retrieval_ms", "mmr_ms", "generation_ms")))
+
+def latency_str(s):
+    if not latency[s]: return ""
+    return f"   p50 {percentile(latency[s], 50)/1000:6.2f}s  p95 {percentile(latency[s], 95)/1000:6.2f}s"
+
 print(f"File: {csv_path}\n")
 for s in totals:
     acc = corrects[s]/totals[s] if totals[s] else 0.0
-    print(f"{s:7} {corrects[s]}/{totals[s]} = {acc:.1%}")
+    print(f"{s:7} {corrects[s]}/{totals[s]} = {acc:.1%}{latency_str(s)}")
 
 # Head-to-head: where RAG beats / loses vs baseline
 wins = [qid for qid, d in by_q.items() if d.get("rag") and not d.get("no_ctx")]
@@ -41,6 +56,6 @@ out = Path("eval/summary.txt")
 with out.open("w", encoding="utf-8") as f:
     for s in totals:
         acc = corrects[s]/totals[s] if totals[s] else 0.0
-        f.write(f"{s}: {corrects[s]}/{totals[s]} = {acc:.1%}\n")
+        f.write(f"{s}: {corrects[s]}/{totals[s]} = {acc:.1%}{latency_str(s)}\n")
     f.write(f"\nRAG wins: {wins}\nRAG losses: {losses}\n")
 print(f"\nSaved {out}")
\ No newline at end of file